@@ -0,0 +1,196 @@
+# Compiled caption tables, a binary companion to the Panorama .kv3 captions. (V1.00)
+# Same idea as the old closecaption .dat files: a directory of hashed tokens pointing into one string blob,
+# so the game can look captions up without parsing thousands of lines of text first.
+#
+# Layout (all integers little-endian):
+#   header     magic "PCCT", version u32, entry count u32, directory offset u32, blob offset u32, blob size u32,
+#              language length u32, language (UTF-8)
+#   directory  one entry per token sorted by hash: CRC32 of the lowercased token u32,
+#              token offset u32, token length u32, value offset u32, value length u32 (offsets into the blob)
+#   blob       the UTF-8 tokens and values, each value already converted to Panorama markup
+
+import sys
+import re
+import struct
+import zlib
+import timeit
+import tracemalloc
+import argparse
+import os
+
+MAGIC = b"PCCT"
+VERSION = 1
+HEADER = struct.Struct("<4sIIIIII")
+ENTRY = struct.Struct("<IIIII")
+HASH = struct.Struct("<I")
+
+# a caption line as written by convert_captions_to_panorama.py ("token" = "value")
+KV3_CAPTION_PATTERN = re.compile(r'^\s*"((?:[^"\\]|\\.)*)"\s*=\s*"(.*)"\s*$')
+KV3_LANGUAGE_PATTERN = re.compile(r'^\s*language\s*=\s*"([^"]*)"')
+KV3_ESCAPE_PATTERN = re.compile(r'\\([\\"])')
+
+
+def hashToken(token: str) -> int:
+    # tokens are case insensitive, so hash them lowercased like the engine does
+    return zlib.crc32(token.lower().encode("utf-8"))
+
+
+def unescapeKv3(text: str) -> str:
+    return KV3_ESCAPE_PATTERN.sub(r"\1", text)
+
+
+def writeTable(path: str, language: str, captions: dict[str, str]):
+    # later duplicates of a token win, same as when the .kv3 is parsed
+    unique = {}
+    for token, value in captions.items():
+        unique[token.lower()] = (token, value)
+
+    entries = sorted(((hashToken(t), t, v) for t, v in unique.values()), key = lambda e: (e[0], e[1].lower()))
+
+    blob = bytearray()
+    directory = bytearray()
+    for h, token, value in entries:
+        t = token.encode("utf-8")
+        v = value.encode("utf-8")
+        directory += ENTRY.pack(h, len(blob), len(t), len(blob) + len(t), len(v))
+        blob += t + v
+
+    lang = language.encode("utf-8")
+    directoryOffset = HEADER.size + len(lang)
+    blobOffset = directoryOffset + len(directory)
+    with open(path, "wb") as file:
+        file.write(HEADER.pack(MAGIC, VERSION, len(entries), directoryOffset, blobOffset, len(blob), len(lang)))
+        file.write(lang)
+        file.write(directory)
+        file.write(blob)
+
+
+class CaptionTable:
+    # reads a compiled caption table, only decoding the entries that are actually looked up
+
+    def __init__(self, path: str):
+        with open(path, "rb") as file:
+            self.data = file.read()
+
+        magic, version, self.count, self.directoryOffset, self.blobOffset, blobSize, langSize = HEADER.unpack_from(self.data, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a caption table")
+        if version != VERSION:
+            raise ValueError(f"{path} is version {version}, expected {VERSION}")
+        self.language = self.data[HEADER.size:HEADER.size + langSize].decode("utf-8")
+
+    def _hash(self, index: int) -> int:
+        # the directory is searched where it sits, nothing is unpacked up front
+        return HASH.unpack_from(self.data, self.directoryOffset + index * ENTRY.size)[0]
+
+    def _string(self, offset: int, length: int) -> str:
+        start = self.blobOffset + offset
+        return self.data[start:start + length].decode("utf-8")
+
+    def entry(self, index: int) -> tuple[str, str]:
+        _, tokenOffset, tokenLength, valueOffset, valueLength = ENTRY.unpack_from(self.data, self.directoryOffset + index * ENTRY.size)
+        return self._string(tokenOffset, tokenLength), self._string(valueOffset, valueLength)
+
+    def lookup(self, token: str) -> str | None:
+        h = hashToken(token)
+        # binary search for the first entry with this hash, then check the tokens in case of collisions
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._hash(mid) < h:
+                lo = mid + 1
+            else:
+                hi = mid
+        lowered = token.lower()
+        while lo < self.count and self._hash(lo) == h:
+            t, v = self.entry(lo)
+            if t.lower() == lowered:
+                return v
+            lo += 1
+        return None
+
+    def items(self):
+        for i in range(self.count):
+            yield self.entry(i)
+
+
+def readKv3(path: str) -> tuple[str, dict[str, str]]:
+    # parses the captions back out of a converted .kv3
+    language = ""
+    captions = {}
+    with open(path, "r", encoding = "utf-8") as file:
+        for line in file:
+            match = KV3_CAPTION_PATTERN.match(line)
+            if match:
+                captions[unescapeKv3(match.group(1))] = unescapeKv3(match.group(2))
+                continue
+            match = KV3_LANGUAGE_PATTERN.match(line)
+            if match:
+                language = match.group(1)
+    return language, captions
+
+
+def measure(load) -> tuple[object, float, int]:
+    # time a load and the peak memory it allocated
+    tracemalloc.start()
+    start = timeit.default_timer()
+    result = load()
+    elapsed = timeit.default_timer() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def verify(tablePath: str, kv3Path: str) -> bool:
+    # check that every caption in the .kv3 comes back out of the table unchanged, and compare the cost of loading each
+    (language, captions), kv3Time, kv3Memory = measure(lambda: readKv3(kv3Path))
+    table, tableTime, tableMemory = measure(lambda: CaptionTable(tablePath))
+
+    problems = []
+    if table.language != language:
+        problems.append(f"language is {table.language}, expected {language}")
+
+    expected = {t.lower(): v for t, v in captions.items()}
+    if table.count != len(expected):
+        problems.append(f"table has {table.count} captions, expected {len(expected)}")
+    for token, value in captions.items():
+        if expected[token.lower()] != value:
+            continue    # overridden by a later duplicate
+        found = table.lookup(token)
+        if found != value:
+            problems.append(f"{token}: got {found!r}, expected {value!r}")
+
+    for p in problems[:20]:
+        print(f"- {p}")
+    if len(problems) > 20:
+        print(f"- ...and {len(problems) - 20} more")
+
+    print(f"\n=== {tablePath}: {table.count} captions, {'OK' if len(problems) == 0 else f'{len(problems)} problems'}")
+    print(f"- kv3:   {os.path.getsize(kv3Path) / 1024:9.1f} KiB on disk, loaded in {kv3Time * 1000:7.1f}ms using {kv3Memory / 1024:9.1f} KiB")
+    print(f"- table: {os.path.getsize(tablePath) / 1024:9.1f} KiB on disk, loaded in {tableTime * 1000:7.1f}ms using {tableMemory / 1024:9.1f} KiB")
+    return len(problems) == 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Inspect or verify a compiled caption table")
+    parser.add_argument("table", help = "Caption table to read")
+    parser.add_argument("--verify", metavar = "KV3", help = "Check the table against the .kv3 it was compiled alongside")
+    parser.add_argument("--lookup", action = "append", default = [], help = "Print the caption for a token")
+    args = parser.parse_args()
+
+    ok = True
+    if args.verify is not None:
+        ok = verify(args.table, args.verify)
+
+    if len(args.lookup) > 0:
+        table = CaptionTable(args.table)
+        for token in args.lookup:
+            value = table.lookup(token)
+            print(f"\"{token}\" = {'(not found)' if value is None else repr(value)}")
+            ok &= value is not None
+
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
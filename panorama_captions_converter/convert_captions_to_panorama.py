@@ -1,4 +1,4 @@
-# Script for converting original VGUI captions into the .kv3 format used by Panorama. (V1.00)
+# Script for converting original VGUI captions into the .kv3 format used by Panorama. (V1.10)
 # Credit goes to gemini/copilot for any regex in this script (it scares me).
 # Extra credit goes to Sirenstorm for putting up with my bombardment of questions :P
 # - Rip Rip Rip
@@ -7,90 +7,190 @@ import sys
 import os
 import pathlib
 import re
+import argparse
+import timeit
+import concurrent.futures
+from captiontable import writeTable, unescapeKv3
 
-# check if input file was provided before doing anything else
-if len(sys.argv) != 2:
-    print("Usage: python convert_captions_to_panorama.py <input_file>")
-    sys.exit(1)
-
-# captions input file (should be UTF-16 since thats what the old VGUI captions use)
-inputFile = sys.argv[1]
-inputFileName = pathlib.Path(inputFile).stem
-
-# set working directory to where the script was ran from
-os.chdir(os.path.dirname(os.path.abspath(sys.argv[0])))
-
-# read the provided file and store lines in a list
-with open(inputFile, "r", encoding = "utf-16") as file:
-    lines = file.readlines()
-
-# detect language of captions
-try:
-    fileLanguage = re.search(r'\s*\"([^\"]+)\"\s+\"([^\"]+)\"', lines[2]).group(2)
-    print(f"\n=== Detected caption language: {fileLanguage}")
-except Exception as e:
-    print(f"=== Error detecting caption language, defaulting to 'english' ({e})")
-    fileLanguage = "english"
-
-# update header to match what panorama wants
-try:
-    print("\n=== Updating file header to match Panorama format...")
-    fileHeader = [
-        "{\n",
-        "	format_version = 0\n",
-        f"	language = \"{fileLanguage}\"\n",
-        "	tokens = {\n",
-        ""]
-    lines[:5] = fileHeader
-except Exception as e:
-    print(f"Error updating file header! {e}")
-
-# iterate through the rest of the lines and update accordingly
-try:
-    print("\n=== Updating caption lines to match Panorama format:")
-    for x in range(5, len(lines) - 1):
-        
-        print(f"- Updating caption line {x}...")
-
-        # get caption line
-        caption = lines[x].strip()
-        
-        # match the first quoted string as the token, and everything inside the second set of quotes as the value
-        match = re.search(r'^"([^"]+)"\s+"(.*)"$', caption)
-
-        if match:   # if its a valid caption in the original format ("token" "value")
-            captionToken = match.group(1)
-            captionValue = match.group(2)
-            
-            # === escape any backslashes in the caption token
-            captionToken = captionToken.replace("\\", "\\\\")
-
-            # replace colour tags (`<clr:250,231,181>` becomes <font color=\"rgb(250,231,181)\">\)
-            captionValue = re.sub(r'<clr:(\d+),(\d+),(\d+)>', r'<font color=\"rgb(\1,\2,\3)\">', captionValue)
-
-            # replace generic caption codes:   <B> --> <b>   <I> --> <i>   <cr> --> <br>
-            captionValue = captionValue.replace("<B>", "<b>").replace("<I>", "<i>").replace("<cr>", "<br>")
-
-            # fix closing <b> tags to be </b> instead of <b> and same for <i>
-            captionValue = re.sub(r'<b>(.*?)<b>', r'<b>\1</b>', captionValue)   # <B>
-            captionValue = re.sub(r'<i>(.*?)<i>', r'<i>\1</i>', captionValue)   # <I>
-
-            # === update the line in the file
-            lines[x] = f"		\"{captionToken}\" = \"{captionValue}\"\n"
-        else:
-            continue
-        
-except Exception as e:
-    print(f"Error updating caption lines! {e}")
+# matches the language line in the header ("Language" "english")
+LANGUAGE_PATTERN = re.compile(r'\s*\"([^\"]+)\"\s+\"([^\"]+)\"')
+
+# match the first quoted string as the token, and everything inside the second set of quotes as the value
+CAPTION_PATTERN = re.compile(r'^"([^"]+)"\s+"(.*)"$')
+
+# every caption code we translate, found in a single pass over the value
+TAG_PATTERN = re.compile(r'<clr:(\d+),(\d+),(\d+)>|<([BbIi])>|<cr>')
 
-# write updated lines back to file (UTF-8 since thats what panorama uses)
-try:
-    print("\n=== Writing updated captions to file...")
+# number of lines at the top of a VGUI captions file that make up the header
+HEADER_LINES = 5
 
-    with open(f"{inputFileName}.kv3", "w", encoding = "utf-8") as file:
-        file.writelines(lines)
 
-    print(f"\n=== Successfully converted captions! Output file: {inputFileName}.kv3\n")
+def detectLanguage(line: str) -> str:
+    try:
+        return LANGUAGE_PATTERN.search(line).group(2)
+    except Exception as e:
+        print(f"=== Error detecting caption language, defaulting to 'english' ({e})")
+        return "english"
 
-except Exception as e:
-    print(f"Error writing captions! {e}")
\ No newline at end of file
+
+def makeHeader(language: str) -> list[str]:
+    # header that matches what panorama wants
+    return [
+        "{\n",
+        "	format_version = 0\n",
+        f"	language = \"{language}\"\n",
+        "	tokens = {\n",
+        ]
+
+
+def convertValue(captionValue: str) -> str:
+    # translate all the caption codes in one go:
+    #   <clr:250,231,181> --> <font color=\"rgb(250,231,181)\">   <cr> --> <br>
+    #   <B>/<b> and <I>/<i> toggle, so every other one becomes the closing </b> or </i>
+    if "<" not in captionValue:
+        return captionValue
+
+    openTags = {"b": False, "i": False}
+
+    def replaceTag(match: re.Match) -> str:
+        if match.group(1) is not None:
+            return f'<font color=\\"rgb({match.group(1)},{match.group(2)},{match.group(3)})\\">'
+        if match.group(4) is not None:
+            tag = match.group(4).lower()
+            openTags[tag] = not openTags[tag]
+            return f"<{tag}>" if openTags[tag] else f"</{tag}>"
+        return "<br>"
+
+    return TAG_PATTERN.sub(replaceTag, captionValue)
+
+
+def convertCaption(line: str) -> tuple[str, str] | None:
+    match = CAPTION_PATTERN.search(line.strip())
+
+    if not match:   # not a caption in the original format ("token" "value")
+        return None
+
+    return match.group(1), convertValue(match.group(2))
+
+
+def convertLine(line: str, caption: tuple[str, str] | None) -> str:
+    if caption is None:     # leave anything that isn't a caption alone
+        return line
+
+    # === escape any backslashes in the caption token
+    captionToken = caption[0].replace("\\", "\\\\")
+
+    return f"		\"{captionToken}\" = \"{caption[1]}\"\n"
+
+
+def convertFile(inputFile: str, outputDir: str, quiet: bool = False, table: bool = False) -> dict:
+    # captions are streamed from input (should be UTF-16 since thats what the old VGUI captions use)
+    # to output (UTF-8 since thats what panorama uses) one line at a time
+    start = timeit.default_timer()
+    outputFile = os.path.join(outputDir, f"{pathlib.Path(inputFile).stem}.kv3")
+    result = {"input": inputFile, "output": outputFile, "lines": 0, "captions": 0, "ok": False}
+    # captions for the compiled table, as they read once the .kv3 escapes are undone
+    captions = {}
+
+    try:
+        with open(inputFile, "r", encoding = "utf-16") as inFile, open(outputFile, "w", encoding = "utf-8") as outFile:
+            # read the header first, the language is on the third line
+            header = []
+            for line in inFile:
+                header.append(line)
+                if len(header) == HEADER_LINES:
+                    break
+
+            fileLanguage = detectLanguage(header[2] if len(header) > 2 else "")
+            if not quiet:
+                print(f"\n=== Detected caption language: {fileLanguage}")
+                print("\n=== Updating file header to match Panorama format...")
+            outFile.writelines(makeHeader(fileLanguage))
+
+            if not quiet:
+                print("\n=== Updating caption lines to match Panorama format:")
+
+            # the last line closes the file and is copied as it is, so hold each line back until we know another follows it
+            x = HEADER_LINES
+            previous = None
+            for line in inFile:
+                if previous is not None:
+                    if not quiet:
+                        print(f"- Updating caption line {x}...")
+                    caption = convertCaption(previous)
+                    if caption is not None:
+                        result["captions"] += 1
+                        if table:
+                            captions[caption[0]] = unescapeKv3(caption[1])
+                    outFile.write(convertLine(previous, caption))
+                    x += 1
+                previous = line
+            if previous is not None:
+                outFile.write(previous)
+                x += 1
+            result["lines"] = x
+
+        if table:
+            tableFile = os.path.join(outputDir, f"{pathlib.Path(inputFile).stem}.cctable")
+            writeTable(tableFile, fileLanguage, captions)
+            result["table"] = tableFile
+            if not quiet:
+                print(f"=== Wrote compiled caption table: {tableFile}")
+
+        result["ok"] = True
+        if not quiet:
+            print(f"\n=== Successfully converted captions! Output file: {outputFile}\n")
+
+    except Exception as e:
+        print(f"Error converting {inputFile}! {e}")
+
+    result["seconds"] = timeit.default_timer() - start
+    return result
+
+
+def findInputs(inputs: list[str], pattern: str) -> list[str]:
+    # directories are searched for caption files, anything else is taken as a caption file
+    files = []
+    for i in inputs:
+        if os.path.isdir(i):
+            files += sorted(str(p) for p in pathlib.Path(i).glob(pattern))
+        else:
+            files.append(i)
+    return files
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Convert VGUI captions to the .kv3 format used by Panorama")
+    parser.add_argument("inputs", nargs = "+", help = "Caption files, or directories of them, to convert")
+    parser.add_argument("-o", "--output-dir", dest = "outputDir", default = os.path.dirname(os.path.abspath(sys.argv[0])), help = "Where to write the .kv3 files. Defaults to the directory this script is in")
+    parser.add_argument("-p", "--pattern", default = "closecaption_*.txt", help = "Caption files to pick up from directories")
+    parser.add_argument("-j", "--jobs", type = int, default = os.cpu_count(), help = "Number of files to convert at once")
+    parser.add_argument("-t", "--table", action = "store_true", help = "Also write a compiled .cctable caption table next to each .kv3 (see captiontable.py)")
+    parser.add_argument("-q", "--quiet", action = "store_true", help = "Only print errors and the summary")
+    args = parser.parse_args()
+
+    files = findInputs(args.inputs, args.pattern)
+    if len(files) == 0:
+        print("=== No caption files found!")
+        sys.exit(1)
+    os.makedirs(args.outputDir, exist_ok = True)
+
+    start = timeit.default_timer()
+    if len(files) == 1 or args.jobs <= 1:
+        results = [convertFile(f, args.outputDir, args.quiet, args.table) for f in files]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers = min(args.jobs, len(files))) as pool:
+            results = list(pool.map(convertFile, files, [args.outputDir] * len(files), [args.quiet] * len(files), [args.table] * len(files)))
+    elapsed = timeit.default_timer() - start
+
+    # === timing summary
+    print(f"\n=== Converted {sum(r['ok'] for r in results)}/{len(results)} files in {elapsed:.2f}s")
+    for r in results:
+        status = "ok" if r["ok"] else "FAILED"
+        print(f"- {r['input']}: {r['captions']} captions, {r['lines']} lines, {r['seconds']:.2f}s {status}")
+
+    sys.exit(0 if all(r["ok"] for r in results) else 1)
+
+
+if __name__ == "__main__":
+    main()
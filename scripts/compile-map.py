@@ -8,11 +8,24 @@ import shutil
 import timeit
 import json
 import string
+import shlex
+import hashlib
+import concurrent.futures
+import platform
+import datetime
+import statistics
+import tempfile
 import sys
+import csv
 if sys.version_info >= (3,11):
 	import tomllib
 else:
 	raise Exception('Python 3.11 or later is required to run this script!')
+from utils.cachedir import get_cache_dir, get_data_dir
+from utils.benchstore import BenchStore
+from utils.benchstats import summarize
+from utils.compilelog import run_streamed
+from utils.flamegraph import fold_perf_script, write_folded, top_symbols, render_svg
 
 """
 Summary of available subs:
@@ -24,30 +37,31 @@ Summary of available subs:
 configs = {
 	'fast': {
 		'steps': ['vbsp', 'vvis', 'vrad'],
-		'vvis': '${bin}/vvis -game ${game} -fast ${bspfile}',
+		'vvis': '${bin}/vvis -game ${game} -threads $threads -fast ${bspfile}',
 		'vrad': '${bin}/vrad -game ${game} -StaticPropLighting -threads $threads -fast ${bspfile}',
 		'vbsp': '${bin}/vbsp -game ${game} ${file}',
 		'vbsp2': '${bin}/vbsp2 -game ${game} ${file}',
 	},
 	'normal': {
 		'steps': ['vbsp', 'vvis', 'vrad'],
-		'vvis': '${bin}/vvis -game ${game} ${bspfile}',
+		'vvis': '${bin}/vvis -game ${game} -threads $threads ${bspfile}',
 		'vrad': '${bin}/vrad -game ${game} -textureshadows -StaticPropLighting -threads $threads ${bspfile}',
 		'vbsp': '${bin}/vbsp -game ${game} ${file}',
 		'vbsp2': '${bin}/vbsp2 -game ${game} ${file}',
 	},
 	'final': {
 		'steps': ['vbsp', 'vvis', 'vrad'],
-		'vvis': '${bin}/vvis -game ${game} ${bspfile}',
+		'vvis': '${bin}/vvis -game ${game} -threads $threads ${bspfile}',
 		'vrad': '${bin}/vrad -game ${game} -final -textureshadows -StaticPropLighting -threads $threads -StaticPropPolys ${bspfile}',
 		'vbsp': '${bin}/vbsp -game ${game} ${file}',
 		'vbsp2': '${bin}/vbsp2 -game ${game} ${file}',
 	}
 }
 
+# $out is the artifact path without extension, $exe the command being profiled
 profilers = {
-	'vtune': '$vtune -collect hotspots $exe',
-	'perf': 'perf record $exe'
+	'vtune': '$vtune -collect hotspots -result-dir $out.vtune -- $exe',
+	'perf': 'perf record -o $out.perf.data $perfopts -- $exe'
 }
 
 argparser = argparse.ArgumentParser(description='Test harness for vrad, vvis, vbsp')
@@ -55,29 +69,212 @@ argparser.add_argument('--profile-vrad', action='store_true')
 argparser.add_argument('--profile-vbsp', action='store_true')
 argparser.add_argument('--profile-vvis', action='store_true')
 argparser.add_argument('--profiler', type=str, choices=list(profilers.keys()))
+argparser.add_argument('--profile-dir', type=str, dest='profile_dir', default='profiles', help='Where profiles are stored, one folder per run. Relative to the working directory')
+argparser.add_argument('--perf-freq', type=int, dest='perf_freq', help='perf sampling frequency in Hz')
+argparser.add_argument('--call-graph', type=str, dest='call_graph', default='fp', choices=['fp', 'dwarf', 'lbr', 'none'], help='perf call graph collection method. Flame graphs need one')
+argparser.add_argument('--profile-top', type=int, dest='profile_top', default=20, help='Number of hottest symbols to record per profile')
 argparser.add_argument('--show-graph', action='store_true')
-argparser.add_argument('--threads', default=multiprocessing.cpu_count(), type=int, help='Number of threads to use. Defaults to half of your systems core count')
+argparser.add_argument('--threads', default=multiprocessing.cpu_count(), type=int, help='Number of threads to use. Defaults to your systems core count')
 argparser.add_argument('--config', nargs='+', default=['normal'], help='Configs to use/compare')
 argparser.add_argument('--game', type=str, default='p2ce', help='Games to compile for')
 argparser.add_argument('--bench', action='store_true', help='Benchmark the compilers')
+argparser.add_argument('--warmup', type=int, default=0, help='Number of untimed compiles to run before benchmarking')
+argparser.add_argument('--repeat', type=int, default=1, help='Number of timed compiles per map/config. Stats are reported across them')
 argparser.add_argument('-o', type=str, dest='OUT', help='Output BSP path')
-argparser.add_argument('map', metavar='Map', type=str, nargs=1, help='Map to compile')
+argparser.add_argument('--incremental', action='store_true', help='Restore stages whose inputs are unchanged from the stage cache instead of running them')
+argparser.add_argument('--cache-dir', type=str, dest='cache_dir', help='Stage cache location. Defaults to the user cache directory')
+argparser.add_argument('--sweep-threads', nargs='*', type=int, dest='sweep_threads', help='Compile the first map at each of these thread counts and report scaling. Defaults to powers of two up to the core count')
+argparser.add_argument('--knee-efficiency', type=float, default=0.7, dest='knee_efficiency', help='Parallel efficiency below which extra threads are considered wasted in a sweep')
+argparser.add_argument('--history', type=str, help='Benchmark history database to append --bench results to. Defaults to compile-history.sqlite in the user data directory')
+argparser.add_argument('--no-history', action='store_true', dest='no_history', help='Don\'t record --bench results in the history database')
+argparser.add_argument('-j', '--jobs', type=int, default=1, help='Number of map/config compiles to run at once. --threads is split between them')
+argparser.add_argument('map', metavar='Map', type=str, nargs='+', help='Maps to compile. Every map is compiled with every config')
 args = argparser.parse_args()
+if args.repeat < 1:
+	argparser.error('--repeat must be at least 1')
+if args.warmup < 0:
+	argparser.error('--warmup can\'t be negative')
 
-timers = []
+# Bump when the layout of the results JSON changes. Files without a version are version 1
+RESULTS_VERSION = 2
 
 # Dead simple timer class for recording elapsed times
 class Timer:
-	def __init__(self, config: str):
+	def __init__(self, config: str, label: str | None = None, mapname: str = ''):
 		self.configname = config
+		self.mapname = mapname
+		# Name used in the results, includes the map when compiling several
+		self.label = label if label is not None else config
+		# Median of the samples for each step
 		self.times = {}
+		self.samples = {}
+		# Stage cache 'hit' or 'miss' per step, only filled in incremental mode. Hits add no samples
+		self.cache = {}
+		# Hash of the binary each step ran, only filled when benchmarking
+		self.tools = {}
+		# Resource usage of each sample per step, where the platform can report it
+		self.usage = {}
+		# Sub-phases parsed from the tool output, a list of phases for each sample per step
+		self.phases = {}
+		# Profile artifacts and hotspot summary of each sample per step, when profiling
+		self.profiles = {}
 
 	def begin_record(self, name):
 		self.curname = name
 		self.curstart = timeit.default_timer()
 
 	def end_record(self):
-		self.times[self.curname] = timeit.default_timer() - self.curstart
+		self.add_sample(self.curname, timeit.default_timer() - self.curstart)
+
+	def add_sample(self, name: str, t: float):
+		if name not in self.samples: self.samples[name] = []
+		self.samples[name].append(t)
+		self.times[name] = statistics.median(self.samples[name])
+
+	def add_usage(self, name: str, usage: dict):
+		if name not in self.usage: self.usage[name] = []
+		self.usage[name].append(usage)
+
+	def add_phases(self, name: str, phases: list[dict]):
+		if name not in self.phases: self.phases[name] = []
+		self.phases[name].append(phases)
+
+	def add_profile(self, name: str, profile: dict):
+		if name not in self.profiles: self.profiles[name] = []
+		self.profiles[name].append(profile)
+
+	def phase_stats(self) -> dict:
+		"""Summary of each phase duration across samples, per step"""
+		out = {}
+		for step, runs in self.phases.items():
+			durations = {}
+			for phases in runs:
+				for ph in phases:
+					if ph['name'] not in durations: durations[ph['name']] = []
+					durations[ph['name']].append(ph['duration'])
+			out[step] = {k: summarize(v) for k, v in durations.items()}
+		return out
+
+	def merge(self, other: 'Timer'):
+		"""Fold in the samples of another run of the same map/config"""
+		for name, ts in other.samples.items():
+			for t in ts:
+				self.add_sample(name, t)
+		for name, us in other.usage.items():
+			for u in us:
+				self.add_usage(name, u)
+		for name, ps in other.phases.items():
+			for ph in ps:
+				self.add_phases(name, ph)
+		for name, ps in other.profiles.items():
+			for pr in ps:
+				self.add_profile(name, pr)
+		self.cache.update(other.cache)
+		self.tools.update(other.tools)
+
+
+def hash_file(path: str) -> str:
+	h = hashlib.sha256()
+	with open(path, 'rb') as fp:
+		while chunk := fp.read(1024 * 1024):
+			h.update(chunk)
+	return h.hexdigest()
+
+
+def hash_tool(cmd: str, step: str | None = None) -> str:
+	"""
+	Hash the compiler a step's command line runs
+	That's the argument named after the step (vrad, vrad.exe...) when there is one, otherwise the first argument
+	that exists on disk. Profilers wrapping the command are never picked, so profiled and plain runs hash the same.
+	"""
+	files = []
+	for a in shlex.split(cmd, posix=not sys.platform.startswith('win')):
+		for p in [a, f'{a}.exe']:
+			if os.path.isfile(p):
+				files.append(p)
+				break
+	tools = [p for p in files if os.path.splitext(os.path.basename(p))[0].lower() not in profilers]
+	for p in tools:
+		if step is not None and os.path.splitext(os.path.basename(p))[0].lower() == step.lower():
+			return hash_file(p)
+	return hash_file(tools[0]) if len(tools) > 0 else ''
+
+
+# Content-addressed store of stage outputs. Each entry holds the BSP and its compile companions
+# as they were after the stage ran.
+class StageCache:
+	outputs = ['.bsp', '.prt', '.lin']
+
+	def __init__(self, path: str):
+		self.path = path
+		os.makedirs(path, exist_ok=True)
+
+	@staticmethod
+	def make_key(parts: list[str]) -> str:
+		return hashlib.sha256('\0'.join(parts).encode()).hexdigest()
+
+	def restore(self, key: str, bspfile: str) -> bool:
+		entry = os.path.join(self.path, key)
+		if not os.path.exists(os.path.join(entry, 'out.bsp')):
+			return False
+		base = os.path.splitext(bspfile)[0]
+		for ext in self.outputs:
+			src = os.path.join(entry, f'out{ext}')
+			if os.path.exists(src):
+				shutil.copyfile(src, base + ext)
+			elif os.path.exists(base + ext):
+				# Don't leave a stale leak/portal file from an older compile around
+				os.remove(base + ext)
+		return True
+
+	def store(self, key: str, bspfile: str):
+		entry = os.path.join(self.path, key)
+		tmp = f'{entry}.tmp'
+		shutil.rmtree(tmp, ignore_errors=True)
+		os.makedirs(tmp)
+		base = os.path.splitext(bspfile)[0]
+		for ext in self.outputs:
+			if os.path.exists(base + ext):
+				shutil.copyfile(base + ext, os.path.join(tmp, f'out{ext}'))
+		shutil.rmtree(entry, ignore_errors=True)
+		os.rename(tmp, entry)
+
+
+class CompileError(Exception):
+	pass
+
+
+def run_stage(cmd: str, log=None, echo: bool = True) -> tuple[int, dict | None, list[dict]]:
+	"""
+	Run a compile step through the shell, streaming its output to the console and log
+	Returns the exit code, the resource usage of the step and everything it spawned, and the phases parsed
+	from its output. Usage is None on platforms without wait4 (Windows).
+	"""
+	p, phases = run_streamed(cmd, log, echo)
+	if not hasattr(os, 'wait4'):
+		return p.wait(), None, phases
+
+	# wait4 reports the shell plus every descendant it waited on, which is the actual tool
+	_, status, ru = os.wait4(p.pid, 0)
+	p.returncode = os.waitstatus_to_exitcode(status)
+	usage = {
+		'user': ru.ru_utime,
+		'system': ru.ru_stime,
+		# Linux reports kilobytes, macOS bytes
+		'max_rss': ru.ru_maxrss * (1 if sys.platform == 'darwin' else 1024),
+		# Block I/O that actually hit the disk, in 512 byte units
+		'read_bytes': ru.ru_inblock * 512,
+		'write_bytes': ru.ru_oublock * 512,
+	}
+	return p.returncode, usage, phases
+
+
+def describe_usage(usage: list[dict]) -> str:
+	cpu = statistics.median([u['cpu_utilisation'] for u in usage])
+	rss = max([u['max_rss'] for u in usage]) / (1024 * 1024)
+	rd = statistics.median([u['read_bytes'] for u in usage]) / (1024 * 1024)
+	wr = statistics.median([u['write_bytes'] for u in usage]) / (1024 * 1024)
+	return f'cpu {cpu * 100:5.1f}% of threads  peak rss {rss:.0f} MiB  read {rd:.0f} MiB  written {wr:.0f} MiB'
 
 
 def check_result(result: subprocess.CompletedProcess):
@@ -91,13 +288,13 @@ def get_bin_directory() -> str:
 	return os.path.abspath(os.path.dirname(__file__) + f'../../../bin/{plat}')
 
 
-def do_replacements(sourcemappath: str, bspfile: str, cmd: str) -> str:
+def do_replacements(sourcemappath: str, bspfile: str, cmd: str, threads: int | None = None) -> str:
 	template = string.Template(cmd)
 	return template.substitute({
 		'game': args.game,
 		'bspfile': bspfile,
 		'file': sourcemappath,
-		'threads': str(args.threads),
+		'threads': str(threads if threads is not None else args.threads),
 		'bin': get_bin_directory()
 	})
 
@@ -119,41 +316,161 @@ def load_config(config: str|None) -> dict|None:
 		return tomllib.load(fp)
 
 
-def inject_profiler():
-	p = profilers[args.profiler]
-	for k in configs.keys():
-		if args.profile_vvis:
-			configs[k]['vvis'] = p.replace('$exe', configs[k]['vvis'])
-		if args.profile_vrad:
-			configs[k]['vrad'] = p.replace('$exe', configs[k]['vrad'])
-		if args.profile_vbsp:
-			configs[k]['vbsp'] = p.replace('$exe', configs[k]['vbsp'])
-			configs[k]['vbsp2'] = p.replace('$exe', configs[k]['vbsp2'])
+# Folder this run's profiles go in, set up by main when profiling
+profile_root: str | None = None
+
+
+def is_profiled(step: str) -> bool:
+	if args.profiler is None:
+		return False
+	return {
+		'vvis': args.profile_vvis,
+		'vrad': args.profile_vrad,
+		'vbsp': args.profile_vbsp,
+		'vbsp2': args.profile_vbsp,
+	}.get(step, False)
+
+
+def profile_base(mapname: str, config: str, step: str) -> str:
+	"""Pick a free artifact path for a profile of this map/config/step, numbering repeat runs"""
+	base = os.path.join(profile_root, f'{mapname.replace("/", "_")}.{config}.{step}')
+	n = 1
+	while any(os.path.exists(f'{base}.{n}{ext}') for ext in ['.perf.data', '.vtune']):
+		n += 1
+	return f'{base}.{n}'
+
+
+def wrap_profiler(cmd: str, out: str) -> str:
+	"""Wrap a step command line with the selected profiler, writing to out"""
+	perfopts = []
+	if args.perf_freq is not None:
+		perfopts.append(f'-F {args.perf_freq}')
+	if args.call_graph != 'none':
+		perfopts.append(f'--call-graph {args.call_graph}')
+	quoted = shlex.quote(out) if os.name == 'posix' else f'"{out}"'
+	return profilers[args.profiler].replace('$out', quoted).replace('$perfopts', ' '.join(perfopts)).replace('$exe', cmd)
+
+
+def collect_profile(out: str) -> dict:
+	"""
+	Post-process the raw profile of a step into a hotspot summary
+	perf data is folded into collapsed stacks and rendered as a flame graph. vtune results are reported as CSV.
+	"""
+	prof = {'profiler': args.profiler}
+	if args.profiler == 'perf':
+		prof['data'] = f'{out}.perf.data'
+		result = subprocess.run(['perf', 'script', '-i', prof['data'], '-F', 'comm,ip,sym,dso'], capture_output=True, text=True, errors='replace')
+		if result.returncode != 0:
+			print(f'WARNING: perf script failed: {result.stderr.strip()}')
+			return prof
+		stacks = fold_perf_script(result.stdout.splitlines())
+		prof['folded'] = f'{out}.folded'
+		prof['flamegraph'] = f'{out}.svg'
+		write_folded(stacks, prof['folded'])
+		render_svg(stacks, prof['flamegraph'], os.path.basename(out))
+		prof['samples'] = sum(stacks.values())
+		prof['top'] = top_symbols(stacks, args.profile_top)
+	elif args.profiler == 'vtune':
+		prof['data'] = f'{out}.vtune'
+		prof['report'] = f'{out}.csv'
+		vtune = shlex.split(profilers['vtune'], posix=os.name == 'posix')[0]
+		result = subprocess.run([vtune, '-report', 'hotspots', '-r', prof['data'], '-format', 'csv', '-csv-delimiter', 'comma',
+			'-report-output', prof['report']], capture_output=True, text=True, errors='replace')
+		if result.returncode != 0 or not os.path.exists(prof['report']):
+			print(f'WARNING: vtune report failed: {result.stderr.strip()}')
+			return prof
+		with open(prof['report'], 'r', newline='', encoding='utf-8', errors='replace') as fp:
+			rows = [r for r in csv.DictReader(fp) if r.get('CPU Time') not in (None, '')]
+		total = sum(float(r['CPU Time']) for r in rows)
+		rows.sort(key=lambda r: float(r['CPU Time']), reverse=True)
+		prof['top'] = [{
+			'symbol': r['Function'],
+			'seconds': float(r['CPU Time']),
+			'percent': float(r['CPU Time']) / total * 100 if total > 0 else 0,
+		} for r in rows[:args.profile_top]]
+	return prof
+
+
+def get_config(mapfile: str, config: str) -> dict:
+	# Find and load the toml, if it exists
+	cfile = load_config(find_config(mapfile))
+	if cfile is not None and config in cfile:
+		return cfile[config]
+	return configs[config]
 
 
-def run_config(mapfile: str, config: str, dir: str, output: str | None):
+def run_config(mapfile: str, config: str, dir: str, output: str | None, cache: StageCache | None = None,
+			   threads: int | None = None, label: str | None = None, log=None, srcmap: str | None = None,
+			   cache_steps: set[str] | None = None, echo: bool = True, name: str | None = None) -> Timer:
 	# This needs to be absolute. The engine makes some nasty assumptions about where compilers are run from
 	if not os.path.isabs(mapfile):
 		mapfile = os.path.abspath(os.path.join(dir, mapfile))
 	
-	# Find and load the toml, if it exists
-	cfile = load_config(find_config(mapfile))
-	if cfile is not None and config in cfile:
-		cfg = cfile[config]
-	else:
-		cfg = configs[config]
+	# Working copies use the config of the map they were copied from
+	cfg = get_config(srcmap if srcmap is not None else mapfile, config)
 
 	bspfile = mapfile.replace('.vmf', '.bsp')
 	isbsp = mapfile.endswith('.bsp')
 	mapname = os.path.basename(bspfile)
 	
-	timer = Timer(config)
+	if name is None:
+		name = os.path.splitext(os.path.basename(srcmap if srcmap is not None else mapfile))[0]
+	timer = Timer(config, label, name)
+
+	# Stage keys chain through the BSP each stage produces, so any upstream change invalidates everything after it
+	srchash = hash_file(mapfile) if cache is not None else ''
+	prevhash = ''
 	
-	for step in cfg['steps']:
-		timer.begin_record(step)
-		r = subprocess.run(do_replacements(mapfile, bspfile, cfg[step]), shell=True)
-		assert r.returncode == 0
-		timer.end_record()
+	# Keep a log of the tool output beside the BSP, unless the caller gave us one
+	ownlog = None
+	if log is None:
+		ownlog = log = open(f'{os.path.splitext(bspfile)[0]}.{config}.compile.log', 'w')
+
+	try:
+		for step in cfg['steps']:
+			cmd = do_replacements(mapfile, bspfile, cfg[step], threads)
+			key = None
+			# Hash the compiler itself, before any profiler gets wrapped around the command
+			if args.bench:
+				timer.tools[step] = hash_tool(cmd, step)
+			if cache is not None and (cache_steps is None or step in cache_steps):
+				key = cache.make_key([step, cmd, hash_tool(cmd, step), srchash, prevhash])
+				if cache.restore(key, bspfile):
+					# Not a timing of the step, so it's kept out of the samples and stats
+					timer.cache[step] = 'hit'
+					print(f'{step}: inputs unchanged, restored from cache')
+					prevhash = hash_file(bspfile)
+					continue
+			timer.begin_record(step)
+			profout = None
+			if is_profiled(step):
+				profout = profile_base(timer.mapname, config, step)
+				cmd = wrap_profiler(cmd, profout)
+			log.write(f'== {step}: {cmd}\n')
+			returncode, usage, phases = run_stage(cmd, log, echo)
+			if returncode != 0:
+				raise CompileError(f'{step} failed with exit code {returncode}')
+			timer.end_record()
+			timer.add_phases(step, phases)
+			if profout is not None:
+				timer.add_profile(step, collect_profile(profout))
+				print(f'{step}: profile written to {profout}.*')
+			if usage is not None:
+				wall = timer.samples[step][-1]
+				cpu = usage['user'] + usage['system']
+				usage['wall'] = wall
+				usage['threads'] = threads if threads is not None else args.threads
+				# Average number of cores busy, and that as a fraction of the threads we asked for
+				usage['cpu_cores'] = cpu / wall if wall > 0 else 0
+				usage['cpu_utilisation'] = usage['cpu_cores'] / usage['threads']
+				timer.add_usage(step, usage)
+			if key is not None:
+				timer.cache[step] = 'miss'
+				cache.store(key, bspfile)
+				prevhash = hash_file(bspfile)
+	finally:
+		if ownlog is not None:
+			ownlog.close()
 
 	if output is not None:
 		if not output.endswith('.bsp'):
@@ -161,23 +478,333 @@ def run_config(mapfile: str, config: str, dir: str, output: str | None):
 		shutil.copyfile(bspfile, output)
 		print(f'Copied {bspfile} to {output}')
 
-	timers.append(timer)
+	return timer
+
+
+# Files beside a map that the compilers write, rather than read
+COMPILE_OUTPUTS = ('.vmf', '.vmx', '.bsp', '.prt', '.lin', '.log')
+
+
+def run_job(mapfile: str, config: str, dir: str, output: str, cache: StageCache | None, threads: int, label: str,
+			echo: bool = False, name: str | None = None, isolate: bool = False) -> Timer:
+	"""
+	Compile one map with one config, writing the BSP to output
+	Compiles in place unless isolate is set, which is only needed when other configs of the same map run at the
+	same time. The map is then compiled from a copy beside it named <map>__<config>, so relative instances
+	still resolve, along with any <map>.* files the compilers read (i.e. <map>.rad). The copy and everything
+	compiled from it are removed afterwards. Either way the tool output is logged to <map>.<config>.compile.log.
+	"""
+	if not os.path.isabs(mapfile):
+		mapfile = os.path.abspath(os.path.join(dir, mapfile))
+	mapdir = os.path.dirname(mapfile)
+	stem, ext = os.path.splitext(os.path.basename(mapfile))
+	logpath = os.path.join(mapdir, f'{stem}.{config}.compile.log')
+	print(f'[{label}] started with {threads} threads, logging to {logpath}')
+
+	if not isolate:
+		bspfile = os.path.splitext(mapfile)[0] + '.bsp'
+		with open(logpath, 'w') as log:
+			timer = run_config(mapfile, config, dir, output if output != bspfile else None, cache, threads, label, log,
+							   echo=echo, name=name)
+		print(f'[{label}] finished in {sum(timer.times.values()):.1f}s, wrote {output}')
+		return timer
+
+	workstem = f'{stem}__{config}'
+	def is_work_file(f: str) -> bool:
+		return f.startswith(f'{workstem}.') or f.startswith(f'{workstem}_')
+	if any(is_work_file(f) for f in os.listdir(mapdir)):
+		raise CompileError(f'{workstem}.* already exists beside the map, remove it to compile {config} alongside other configs')
+	workmap = os.path.join(mapdir, workstem + ext)
+	try:
+		shutil.copyfile(mapfile, workmap)
+		for f in os.listdir(mapdir):
+			rest = f[len(stem):]
+			if f.startswith(stem) and rest.startswith('.') and not rest.lower().endswith(COMPILE_OUTPUTS):
+				shutil.copyfile(os.path.join(mapdir, f), os.path.join(mapdir, workstem + rest))
+		with open(logpath, 'w') as log:
+			timer = run_config(workmap, config, dir, None, cache, threads, label, log, mapfile, echo=echo, name=name)
+		shutil.copyfile(os.path.join(mapdir, workstem + '.bsp'), output)
+	finally:
+		for f in os.listdir(mapdir):
+			if is_work_file(f):
+				os.remove(os.path.join(mapdir, f))
+	print(f'[{label}] finished in {sum(timer.times.values()):.1f}s, wrote {output}')
+	return timer
+
+
+def map_names(maps: list[str], dir: str) -> dict[str, str]:
+	"""
+	Name of each map for result labels, the file name without the extension. When several maps share a file
+	name, all of them are named by their path below the folder they have in common instead, e.g.
+	mapsrc/a/test.vmf and mapsrc/b/test.vmf are a/test and b/test
+	"""
+	rel = {m: os.path.splitext(os.path.relpath(os.path.abspath(os.path.join(dir, m)), dir))[0] for m in maps}
+	stems = [os.path.basename(r) for r in rel.values()]
+	if len(set(stems)) == len(stems):
+		return {m: os.path.basename(r) for m, r in rel.items()}
+	common = os.path.commonpath([os.path.dirname(os.path.abspath(r)) for r in rel.values()])
+	return {m: os.path.relpath(os.path.abspath(r), common).replace(os.sep, '/') for m, r in rel.items()}
+
+
+def run_jobs(maps: list[str], configs: list[str], dir: str, output: str | None, cache: StageCache | None, jobs: int) -> list[Timer] | None:
+	"""
+	Compile every map with every config, running up to jobs compiles at once
+	Each config of a map gets its own output BSP however many run at once, so results don't depend on jobs.
+	Maps are compiled in place, only configs of the same map that run at the same time use a working copy
+	"""
+	todo = [(m, c) for m in maps for c in configs]
+	workers = max(1, min(jobs, len(todo)))
+	# Split threads between concurrent jobs so vrad runs don't oversubscribe the machine
+	threads = max(1, args.threads // workers)
+	names = map_names(maps, dir)
+
+	futures = []
+	with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+		for m, c in todo:
+			label = c if len(maps) == 1 else f'{names[m]}/{c}'
+			# Each config of a map gets its own BSP, unless there's only the one. Maps sharing a name in the
+			# same output folder are told apart by their path
+			stem = names[m].replace('/', '_') if output is not None else os.path.splitext(os.path.basename(m))[0]
+			name = f'{stem}.bsp' if len(configs) == 1 else f'{stem}_{c}.bsp'
+			if output is None:
+				out = os.path.join(os.path.dirname(os.path.abspath(os.path.join(dir, m))), name)
+			elif output.endswith('.bsp') and len(todo) == 1:
+				out = output
+			else:
+				out = os.path.join(os.path.dirname(output) if output.endswith('.bsp') else output, name)
+			# Output only goes to the console when it can't interleave with another compile
+			isolate = workers > 1 and len(configs) > 1
+			futures.append((label, pool.submit(run_job, m, c, dir, out, cache, threads, label, workers == 1, names[m], isolate)))
+
+	timers = []
+	for label, f in futures:
+		try:
+			timers.append(f.result())
+		except Exception as e:
+			print(f'ERROR: [{label}] compile failed: {e}')
+	return timers if len(timers) == len(futures) else None
+
+
+def compile_all(cwd: str, cache: StageCache | None) -> list[Timer]:
+	"""Compile every map with every config once, exiting on failure"""
+	timers = run_jobs(args.map, args.config, cwd, args.OUT, cache, args.jobs)
+	if timers is None:
+		print('\033[93mERROR: Compile FAILED!\n\033[0m')
+		exit(1)
+	return timers
+
+
+def get_cpu_model() -> str:
+	if sys.platform.startswith('linux'):
+		try:
+			with open('/proc/cpuinfo', 'r') as fp:
+				for line in fp:
+					if line.startswith('model name'):
+						return line.split(':', 1)[1].strip()
+		except OSError:
+			pass
+	return platform.processor()
+
+
+def get_machine_info() -> dict:
+	return {
+		'cpu': get_cpu_model(),
+		'cores': os.cpu_count(),
+		'platform': platform.platform(),
+		'hostname': platform.node(),
+		'python': platform.python_version(),
+	}
 
 
-def output_results(timers: list[Timer]):
+def output_results(timers: list[Timer]) -> dict:
 	outs = {}
+	outs['version'] = RESULTS_VERSION
+	outs['timestamp'] = datetime.datetime.now(datetime.timezone.utc).isoformat()
+	outs['machine'] = get_machine_info()
+	outs['settings'] = {
+		'game': args.game,
+		'maps': args.map,
+		'threads': args.threads,
+		'jobs': args.jobs,
+		'warmup': args.warmup,
+		'repeat': args.repeat,
+	}
 	outs['configs'] = configs
+	# Map and config each result label was compiled from
+	outs['labels'] = {t.label: {'map': t.mapname, 'config': t.configname} for t in timers}
+	# Median time per step, graph-map-results reads this
 	outs['results'] = {}
+	outs['stats'] = {}
+	outs['samples'] = {}
+	outs['tools'] = {}
+	outs['usage'] = {}
+	outs['phases'] = {}
+	outs['phase_samples'] = {}
+	outs['cache'] = {}
 	for t in timers:
-		outs['results'][t.configname] = t.times
+		outs['results'][t.label] = t.times
+		outs['stats'][t.label] = {k: summarize(v) for k, v in t.samples.items()}
+		outs['samples'][t.label] = t.samples
+		outs['tools'][t.label] = t.tools
+		outs['usage'][t.label] = t.usage
+		outs['phases'][t.label] = t.phase_stats()
+		outs['phase_samples'][t.label] = t.phases
+		if len(t.cache) > 0:
+			outs['cache'][t.label] = t.cache
+		if len(t.profiles) > 0:
+			outs.setdefault('profiles', {})[t.label] = t.profiles
+	write_results(outs, 'results')
+	return outs
+
+
+def record_history(outs: dict, cwd: str):
+	"""Append benchmark results to the history database"""
+	path = os.path.join(cwd, args.history) if args.history is not None else os.path.join(get_data_dir(), 'compile-history.sqlite')
+	store = BenchStore(path)
+	try:
+		n = store.add_results(outs)
+	finally:
+		store.close()
+	print(f'Recorded {n} results in {path}')
+
+
+def write_results(outs: dict, prefix: str):
 	# Find appropriate file to write to
-	p = 'results.json'
+	p = f'{prefix}.json'
 	i = 1
 	while os.path.exists(p):
-		p = f'results{i}.json'
+		p = f'{prefix}{i}.json'
 		i += 1
 	with open(p, 'w') as fp:
-		json.dump(outs, fp)
+		json.dump(outs, fp, indent='\t')
+	print(f'Wrote results to {os.path.abspath(p)}')
+
+
+def default_sweep_threads() -> list[int]:
+	cores = multiprocessing.cpu_count()
+	t = [1]
+	while t[-1] * 2 < cores:
+		t.append(t[-1] * 2)
+	if t[-1] != cores:
+		t.append(cores)
+	return t
+
+
+def analyze_scaling(threads: list[int], times: list[float], knee_efficiency: float) -> dict:
+	"""
+	Compute speedup and parallel efficiency relative to the lowest thread count
+	The knee is the highest thread count that still runs at or above knee_efficiency, past that extra cores
+	are mostly wasted.
+	"""
+	base_threads = threads[0]
+	base = times[0]
+	speedup = [base / t if t > 0 else 0 for t in times]
+	efficiency = [s / (n / base_threads) for s, n in zip(speedup, threads)]
+	knee = base_threads
+	for n, e in zip(threads, efficiency):
+		if e >= knee_efficiency:
+			knee = n
+	return {
+		'times': times,
+		'speedup': speedup,
+		'efficiency': efficiency,
+		'knee': knee,
+	}
+
+
+def run_sweep(cwd: str) -> dict:
+	"""
+	Compile the first map with each config at every sweep thread count
+	Runs are one at a time, so like run_jobs with a single worker the map is compiled in place
+	"""
+	mapfile = args.map[0]
+	threads = sorted(set(args.sweep_threads)) if len(args.sweep_threads) > 0 else default_sweep_threads()
+	absmap = mapfile if os.path.isabs(mapfile) else os.path.abspath(os.path.join(cwd, mapfile))
+
+	outs = {}
+	outs['version'] = RESULTS_VERSION
+	outs['kind'] = 'thread-sweep'
+	outs['timestamp'] = datetime.datetime.now(datetime.timezone.utc).isoformat()
+	outs['machine'] = get_machine_info()
+	outs['settings'] = {
+		'game': args.game,
+		'map': mapfile,
+		'threads': threads,
+		'warmup': args.warmup,
+		'repeat': args.repeat,
+		'knee_efficiency': args.knee_efficiency,
+	}
+	outs['configs'] = configs
+	outs['sweep'] = {}
+
+	# Steps that don't take a thread count only need to run once, the stage cache restores them for the other points
+	with tempfile.TemporaryDirectory() as tmp:
+		cache = StageCache(tmp)
+		for c in args.config:
+			cfg = get_config(absmap, c)
+			threaded = {s for s in cfg['steps'] if 'threads' in cfg[s]}
+			fixed = set(cfg['steps']) - threaded
+			# Time of the one real run of each fixed step
+			fixed_times = {}
+			for i in range(args.warmup):
+				print(f'== [{c}] Warmup run {i + 1}/{args.warmup}')
+				run = run_config(mapfile, c, cwd, None, cache, threads[-1], c, cache_steps=fixed)
+				fixed_times.update({s: run.times[s] for s, r in run.cache.items() if r == 'miss'})
+
+			timers = []
+			for t in threads:
+				timer = None
+				for i in range(args.repeat):
+					print(f'== [{c}] {t} threads, run {i + 1}/{args.repeat}')
+					run = run_config(mapfile, c, cwd, None, cache, t, c, cache_steps=fixed)
+					fixed_times.update({s: run.times[s] for s, r in run.cache.items() if r == 'miss'})
+					if timer is None:
+						timer = run
+					else:
+						timer.merge(run)
+				timers.append(timer)
+
+			res = {
+				'threads': threads,
+				'stages': {},
+				'fixed': fixed_times,
+				'stats': [{k: summarize(v) for k, v in tm.samples.items() if k in threaded} for tm in timers],
+				'usage': [{k: v for k, v in tm.usage.items() if k in threaded} for tm in timers],
+			}
+			for s in cfg['steps']:
+				if s in threaded:
+					res['stages'][s] = analyze_scaling(threads, [tm.times[s] for tm in timers], args.knee_efficiency)
+			outs['sweep'][c] = res
+	return outs
+
+
+def print_sweep(outs: dict):
+	for c, res in outs['sweep'].items():
+		print(f'{c}:')
+		for step, st in res['stages'].items():
+			print(f'  {step} (knee at {st["knee"]} threads)')
+			for n, t, sp, e in zip(res['threads'], st['times'], st['speedup'], st['efficiency']):
+				print(f'    {n:4d} threads {t:8.2f}s  speedup {sp:5.2f}x  efficiency {e * 100:5.1f}%')
+
+
+def print_stats(timers: list[Timer]):
+	for t in timers:
+		print(f'{t.label}:')
+		for step, samples in t.samples.items():
+			st = summarize(samples)
+			line = f'  {step:8s} median {st["median"]:8.2f}s  min {st["min"]:8.2f}s  mean {st["mean"]:8.2f}s'
+			if st['stddev'] is not None:
+				line += f'  stddev {st["stddev"]:6.2f}s  95% CI [{st["ci95"][0]:.2f}, {st["ci95"][1]:.2f}]'
+			print(line)
+			if step in t.usage:
+				print(f'  {"":8s} {describe_usage(t.usage[step])}')
+			for name, ph in t.phase_stats().get(step, {}).items():
+				print(f'  {"":8s} {name:24s} median {ph["median"]:8.2f}s')
+			for prof in t.profiles.get(step, [])[-1:]:
+				for sym in prof.get('top', [])[:5]:
+					print(f'  {"":8s} hot {sym["percent"]:5.1f}%  {sym["symbol"]}')
+				if 'flamegraph' in prof:
+					print(f'  {"":8s} flame graph {prof["flamegraph"]}')
 
 
 def main():
@@ -202,13 +829,52 @@ def main():
 	
 	# Now run!
 	if args.profiler is not None:
-		inject_profiler()
-	for c in args.config:
-		run_config(args.map[0], c, cwd, args.OUT)
+		global profile_root
+		stamp = datetime.datetime.now().strftime('%Y%m%d-%H%M%S')
+		profile_root = os.path.join(cwd, args.profile_dir, stamp)
+		os.makedirs(profile_root, exist_ok=True)
+		print(f'Writing profiles to {profile_root}')
+	cache = None
+	if args.incremental:
+		cache = StageCache(os.path.join(cwd, args.cache_dir) if args.cache_dir is not None else os.path.join(get_cache_dir(), 'compile-stages'))
+	repeated = args.warmup > 0 or args.repeat > 1
+	if repeated and cache is not None:
+		# Every run after the first would be a cache hit
+		print('WARNING: --incremental is ignored with --warmup/--repeat')
+		cache = None
+
+	if args.sweep_threads is not None:
+		try:
+			outs = run_sweep(cwd)
+		except CompileError as e:
+			print(f'ERROR: {e}')
+			print('\033[93mERROR: Compile FAILED!\n\033[0m')
+			exit(1)
+		print_sweep(outs)
+		write_results(outs, 'sweep')
+		return
+
+	for i in range(args.warmup):
+		print(f'== Warmup run {i + 1}/{args.warmup}')
+		compile_all(cwd, cache)
+
+	timers = None
+	for i in range(args.repeat):
+		if args.repeat > 1:
+			print(f'== Run {i + 1}/{args.repeat}')
+		run = compile_all(cwd, cache)
+		if timers is None:
+			timers = run
+		else:
+			for t, r in zip(timers, run):
+				t.merge(r)
 	
 	# Post build results
 	if args.bench:
-		output_results(timers)
+		print_stats(timers)
+		outs = output_results(timers)
+		if not args.no_history:
+			record_history(outs, cwd)
 
 
 if __name__ == '__main__':
@@ -3,10 +3,12 @@
 import os
 import subprocess
 import argparse
-import urllib.request
-import urllib3
 import string
 import json
+import timeit
+import statistics
+import concurrent.futures
+from utils.download import Downloader
 
 parser = argparse.ArgumentParser()
 parser.add_argument('-u', '--url', action='append', dest='URLS', help='URL or name of a texture on polyhaven')
@@ -15,6 +17,9 @@ parser.add_argument('-r', default='1k', dest='RES', choices=['1k', '2k', '4k', '
 parser.add_argument('-l', dest='LIST', type=str, help='List of textures to download')
 parser.add_argument('-f', '--force', dest='FORCE', action='store_true', help='Force redownload/conversion of textures, even if they already exist')
 parser.add_argument('--no-vmt', action='store_true', dest='NO_VMT', help='Dont generate VMTs')
+parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(), dest='JOBS', help='Number of vtex2 conversions to run at once. Defaults to your systems core count')
+parser.add_argument('--downloads', type=int, default=8, dest='DOWNLOADS', help='Number of files to download at once')
+parser.add_argument('--base-url', type=str, dest='BASE_URL', default='https://dl.polyhaven.org/file/ph-assets/Textures/png', help='Where to download textures from')
 
 MATERIAL_TEMPLATE = '''
 PBR
@@ -42,47 +47,48 @@ def get_materials_subdir(path: str) -> str | None:
 	return None
 
 
-def get_texture(name: str, res: str, odir: str, mdir: str, do_vmt: bool, force: bool) -> bool:
-	if os.path.exists(f'{odir}/{name}.vmt') and not force:
-		print(f'Skipping {name}, already downloaded.')
-		return True
+class Material:
+	"""
+	State of one texture as it moves through the download and conversion stages
+	"""
+	def __init__(self, name: str):
+		self.name = name
+		# Path of every map that was downloaded, by type
+		self.textures: dict[str, str] = {}
+		self.downloads_left = 0
+		self.download_time = 0.0
+		self.download_bytes = 0
+		self.conversions_left = 0
+		# Wall time of each vtex2 step
+		self.convert_times: dict[str, float] = {}
+		self.failed = False
+
+
+def timed_fetch(dl: Downloader, url: str, tex: str, reuse: bool) -> tuple[int | None, float]:
+	start = timeit.default_timer()
+	received = dl.fetch(url, tex, reuse)
+	return received, timeit.default_timer() - start
+
+
+def run_vtex2(args: list[str]) -> tuple[int, float]:
+	start = timeit.default_timer()
+	r = subprocess.run(args)
+	return r.returncode, timeit.default_timer() - start
 
-	print(f'Fetching {name}...', end='', flush=True)
-	types = ['nor_dx', 'ao', 'disp', 'diff', 'rough']
-	textures = {}
-	for type in types:
-		url = f'https://dl.polyhaven.org/file/ph-assets/Textures/png/{res}/{name}/{name}_{type}_{res}.png'
-		tex = f'{odir}/{name}_{type}_{res}.png'
-		try:
-			r = urllib3.request('GET', url)
-			with open(tex, 'wb') as fp:
-				fp.write(r.data)
-			textures[type] = tex
-		except Exception as e:
-			print(tex)
-			print(f'{url}: {e}')
-			pass
-	print('Done!')
-
-	print(f'Converting {name} textures...', end='', flush=True)
+
+def get_conversions(name: str, odir: str, textures: dict[str, str]) -> dict[str, list[str]]:
+	"""The vtex2 command lines needed for a material. They don't depend on each other, so can all run at once"""
+	steps = {}
 
 	# Convert or pack normal map
-	r = None
 	if 'nor_dx' in textures:
 		if 'disp' in textures:
-			r = subprocess.run(['vtex2', 'pack', '-n', '-q', '--normal-map', textures['nor_dx'], '--height-map', textures['disp'], '-o', f'{odir}/{name}_n.vtf'])
+			steps['normal'] = ['vtex2', 'pack', '-n', '-q', '--normal-map', textures['nor_dx'], '--height-map', textures['disp'], '-o', f'{odir}/{name}_n.vtf']
 		else:
-			r = subprocess.run(['vtex2', 'convert', '-q', '-f', 'bc7', '-o', f'{odir}/{name}_n.vtf', textures['nor_dx']])
-
-	if r.returncode != 0:
-		print('Failed to pack normal')
-		return False
+			steps['normal'] = ['vtex2', 'convert', '-q', '-f', 'bc7', '-o', f'{odir}/{name}_n.vtf', textures['nor_dx']]
 
 	# Convert diffuse
-	r = subprocess.run(['vtex2', 'convert', '-q', '-f', 'bc7', '-o', f'{odir}/{name}_color.vtf', textures['diff']])
-	if r.returncode != 0:
-		print('Failed to convert diffuse')
-		return False
+	steps['color'] = ['vtex2', 'convert', '-q', '-f', 'bc7', '-o', f'{odir}/{name}_color.vtf', textures['diff']]
 
 	# Pack MRAO
 	args = ['vtex2', 'pack', '--mrao', '-q', '-o', f'{odir}/{name}_mrao.vtf']
@@ -102,25 +108,112 @@ def get_texture(name: str, res: str, odir: str, mdir: str, do_vmt: bool, force:
 	else:
 		args += ['--metalness-const', '0']
 
-	r = subprocess.run(args=args)
-	if r.returncode != 0:
-		print('Failed to pack MRAO')
-		return False
+	steps['mrao'] = args
+	return steps
+
+
+def write_vmt(name: str, odir: str, mdir: str, textures: dict[str, str]):
+	vmt = string.Template(MATERIAL_TEMPLATE).substitute({
+			'mrao': f'{mdir}/{name}_mrao',
+			'disp': f'{mdir}/{name}_n.vtf',
+			'color': f'{mdir}/{name}_color.vtf',
+			'use_parallax': '1' if 'disp' in textures else '0'
+	})
+
+	with open(f'{odir}/{name}.vmt', 'w') as fp:
+		fp.write(vmt)
 
-	if do_vmt:
-		# Generate VMT
-		vmt = string.Template(MATERIAL_TEMPLATE).substitute({
-				'mrao': f'{mdir}/{name}_mrao',
-				'disp': f'{mdir}/{name}_n.vtf',
-				'color': f'{mdir}/{name}_color.vtf',
-				'use_parallax': '1' if 'disp' in textures else '0'
-		})
 
-		with open(f'{odir}/{name}.vmt', 'w') as fp:
-			fp.write(vmt)
+def run_pipeline(names: list[str], res: str, odir: str, mdir: str, do_vmt: bool, force: bool, base_url: str,
+				 downloads: int, jobs: int) -> list[Material]:
+	"""
+	Download and convert textures as a two stage pipeline
 
-	print('Done!')
-	return True
+	Every map of every texture is queued on the download pool up front. As soon as the last map of a
+	texture arrives, its vtex2 conversions are queued on the conversion pool, so the CPU is busy converting
+	earlier textures while later ones are still downloading.
+
+	Returns
+	-------
+	list[Material]
+		Every material that was worked on, with its timings
+	"""
+	types = ['nor_dx', 'ao', 'disp', 'diff', 'rough']
+	dl = Downloader(downloads)
+	materials = []
+	# What each outstanding future is for: (material, 'download'/'convert', map type or step)
+	pending = {}
+
+	with concurrent.futures.ThreadPoolExecutor(max_workers=downloads) as fetchers, \
+		 concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as converters:
+		for name in names:
+			if os.path.exists(f'{odir}/{name}.vmt') and not force:
+				print(f'Skipping {name}, already downloaded.')
+				continue
+			m = Material(name)
+			materials.append(m)
+			for type in types:
+				url = f'{base_url}/{res}/{name}/{name}_{type}_{res}.png'
+				tex = f'{odir}/{name}_{type}_{res}.png'
+				pending[fetchers.submit(timed_fetch, dl, url, tex, not force)] = (m, 'download', (type, url, tex))
+				m.downloads_left += 1
+
+		while len(pending) > 0:
+			done, _ = concurrent.futures.wait(pending.keys(), return_when=concurrent.futures.FIRST_COMPLETED)
+			for f in done:
+				m, stage, what = pending.pop(f)
+				if stage == 'download':
+					type, url, tex = what
+					m.downloads_left -= 1
+					try:
+						received, t = f.result()
+						m.download_time += t
+						if received is not None:
+							m.textures[type] = tex
+							# Files kept from an earlier run count as 0, so the rate is only what came over the wire
+							m.download_bytes += received
+					except Exception as e:
+						print(f'[{m.name}] {url}: {e}')
+					if m.downloads_left > 0:
+						continue
+					if 'diff' not in m.textures:
+						print(f'[{m.name}] No diffuse map found, is the name right?')
+						m.failed = True
+						continue
+					print(f'[{m.name}] Downloaded {len(m.textures)} maps, converting...')
+					for step, args in get_conversions(m.name, odir, m.textures).items():
+						pending[converters.submit(run_vtex2, args)] = (m, 'convert', step)
+						m.conversions_left += 1
+				else:
+					m.conversions_left -= 1
+					code, t = f.result()
+					m.convert_times[what] = t
+					if code != 0:
+						print(f'[{m.name}] Failed to convert {what}')
+						m.failed = True
+					if m.conversions_left == 0 and not m.failed:
+						if do_vmt:
+							write_vmt(m.name, odir, mdir, m.textures)
+						print(f'Done with {m.name}!')
+	return materials
+
+
+def print_summary(materials: list[Material], skipped: int, elapsed: float, jobs: int):
+	failed = sum(1 for m in materials if m.failed)
+	print(f'\n{len(materials)} materials in {elapsed:.1f}s ({failed} failed, {skipped} skipped)')
+	if len(materials) == 0:
+		return
+	nbytes = sum(m.download_bytes for m in materials)
+	fetch = sum(m.download_time for m in materials)
+	nmaps = sum(len(m.textures) for m in materials)
+	print(f'  {"download":8s} {nmaps:5d} maps  {nbytes / (1024 * 1024):9.1f} MiB  busy {fetch:8.1f}s  {nbytes / (1024 * 1024) / max(elapsed, 1e-6):7.1f} MiB/s overall')
+	busy = 0.0
+	for step in ['normal', 'color', 'mrao']:
+		times = [m.convert_times[step] for m in materials if step in m.convert_times]
+		if len(times) > 0:
+			busy += sum(times)
+			print(f'  {step:8s} {len(times):5d} runs  busy {sum(times):8.1f}s  median {statistics.median(times):6.2f}s')
+	print(f'  vtex2 workers busy {busy / max(elapsed * jobs, 1e-6) * 100:.0f}% of the run')
 
 
 def check_programs():
@@ -136,19 +229,17 @@ def main():
 
 	mdir = get_materials_subdir(args.PATH)
 
-	r = 0
-	for u in args.URLS if args.URLS is not None else []:
-		if not get_texture(u, args.RES, args.PATH, mdir, not args.NO_VMT, args.FORCE):
-			r = 1
-
-	l = []
+	names = list(args.URLS) if args.URLS is not None else []
 	if args.LIST is not None:
 		with open(args.LIST, 'r') as fp:
-			l = json.load(fp)
-
-	for u in l:
-		if not get_texture(u, args.RES, args.PATH, mdir, not args.NO_VMT, args.FORCE):
-			r = 1
+			names += json.load(fp)
+	# A name given twice would have two workers writing the same .part file
+	names = list(dict.fromkeys(names))
+
+	start = timeit.default_timer()
+	materials = run_pipeline(names, args.RES, args.PATH, mdir, not args.NO_VMT, args.FORCE, args.BASE_URL, args.DOWNLOADS, args.JOBS)
+	print_summary(materials, len(names) - len(materials), timeit.default_timer() - start, args.JOBS)
+	r = 1 if any(m.failed for m in materials) else 0
 
 	exit(r)
 
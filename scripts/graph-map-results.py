@@ -1,74 +1,84 @@
 #!/usr/bin/env python3
 
 # Totally garbage script to graph map compile results
+import os
+import sys
+import csv
 import json
 import typing
+import datetime
 import matplotlib.pyplot as plt
 import argparse
 import numpy as np
+from utils.benchstats import welch_test
+from utils.benchstore import BenchStore, moving_median
+from utils.cachedir import get_data_dir
 
 argparser = argparse.ArgumentParser()
-argparser.add_argument('results', metavar='results', type=str, help='Results file to use')
+argparser.add_argument('results', metavar='results', type=str, nargs='*', help='Results files to use. Thread sweep results are plotted as scaling curves. With --history, these are imported into the database')
 argparser.add_argument('--exclude-vvis', action='store_true', help='Dont plot vvis')
 argparser.add_argument('--exclude-vbsp', action='store_true', help='Dont plot vbsp')
 argparser.add_argument('--exclude-vrad', action='store_true', help='Dont plot vrad')
 argparser.add_argument('--exclude-vbsp2', action='store_true', help='Dont plot vbsp2')
+argparser.add_argument('--compare', action='store_true', help='Compare candidates against the first results file (the baseline). Exits with 1 on a regression, 2 if the files can\'t be compared')
+argparser.add_argument('--threshold', type=float, default=5.0, help='Slowdown in percent past which a stage counts as a regression')
+argparser.add_argument('--output', type=str, help='Save the graph to this file (PNG, SVG, ...) instead of showing it')
+argparser.add_argument('--csv', type=str, help='Write the comparison table as CSV to this file')
+argparser.add_argument('--markdown', type=str, help='Write the comparison table as markdown to this file')
+argparser.add_argument('--history', type=str, nargs='?', const='', help='Plot trends from a compile-map history database. Defaults to the one compile-map --bench writes')
+argparser.add_argument('--map', type=str, help='Only plot history for this map')
+argparser.add_argument('--config', type=str, help='Only plot history for this config')
+argparser.add_argument('--stage', type=str, help='Only plot history for this stage')
+argparser.add_argument('--machine', type=str, help='Only plot history from machines whose name or CPU contains this')
+argparser.add_argument('--window', type=int, default=5, help='Number of runs in the history moving median')
+argparser.add_argument('--no-show', action='store_true', dest='no_show', help='Never open a window, for headless runs')
 
 args = argparser.parse_args()
 
+excluded = {s for s in ['vvis', 'vbsp', 'vrad', 'vbsp2'] if getattr(args, f'exclude_{s}')}
+
 def get_key(c: dict, k: str) -> typing.Any:
 	try:
 		return round(c[k],2)
 	except:
 		return None
 
+def get_stages(res: dict) -> list[str]:
+	"""Every stage present in a results file, in the order they first appear"""
+	stages = []
+	for config in res['results'].values():
+		for k in config.keys():
+			if k not in stages and k not in excluded:
+				stages.append(k)
+	return stages
+
+def finish_plot(fig):
+	fig.tight_layout()
+	if args.output is not None:
+		fig.savefig(args.output)
+		print(f'Saved graph to {args.output}')
+	elif not args.no_show:
+		plt.show()
+
 def plot_results(res: dict):
 	fig, xbars = plt.subplots()
 	
 	xbars.set_ylabel('Time (seconds)')
 	xbars.set_xlabel('Configuration type')
 	
-	vrad = []
-	vvis = []
-	vbsp = []
-	vbsp2 = []
-	for config in res['results'].values():
-		vrad.append(get_key(config, 'vrad'))
-		vvis.append(get_key(config, 'vvis'))
-		vbsp.append(get_key(config, 'vbsp'))
-		vbsp2.append(get_key(config,'vbsp2'))
-	
 	graphs = {}
-	if not args.exclude_vrad and len(vrad) != 0 and vrad[0] is not None:
-		graphs['vrad'] = vrad
-	if not args.exclude_vvis and len(vvis) != 0 and vvis[0] is not None:
-		graphs['vvis'] = vvis
-	if not args.exclude_vbsp and len(vbsp) != 0 and vbsp[0] is not None:
-		graphs['vbsp'] = vbsp
-	if not args.exclude_vbsp2 and len(vbsp2) != 0 and vbsp2[0] is not None:
-		graphs['vbsp2'] = vbsp2
+	for stage in get_stages(res):
+		graphs[stage] = [get_key(config, stage) for config in res['results'].values()]
 	
 	numgraphs = len(graphs)
-	cringe = 0
-	for m in graphs.values():
-		cringe = len(m)
-		break
-	barpos = np.arange(cringe)
+	barpos = np.arange(len(res['results']))
 	w = 0.5
+	inc = w / max(numgraphs, 1)
 	
-	i = 0
-	labels = []
-	for k,g in graphs.items():
-		inc = w / numgraphs
-		l = None
-		if numgraphs == 3:
-			l = xbars.bar(barpos + inc*(i-1), g, w / numgraphs, label=k)
-		elif numgraphs == 2:
-			l = xbars.bar(barpos + (inc/2*i) + (inc/2*(i-1)), g, w / numgraphs, label=k)
-		elif numgraphs == 1:
-			l = xbars.bar(barpos, g, w, label=k)
+	# Spread the bars for each stage evenly around the tick
+	for i, (k, g) in enumerate(graphs.items()):
+		l = xbars.bar(barpos + inc * (i - (numgraphs - 1) / 2), [v if v is not None else 0 for v in g], inc, label=k)
 		xbars.bar_label(l, padding=1)
-		i+=1
 	
 	labels = []
 	for k in res['results'].keys():
@@ -77,12 +87,238 @@ def plot_results(res: dict):
 	xbars.set_xticks(barpos, labels)
 	xbars.legend()
 	xbars.set_title('Compile tools performance comparison')
-	fig.tight_layout()
-	plt.show()
+	finish_plot(fig)
+
+def compare_results(baseline: dict, candidates: list[tuple[str, dict]]) -> list[dict]:
+	"""
+	Line up each candidate against the baseline by config and stage
+	Medians are compared when the files have them. If both sides carry repeated samples, a Welch t-test
+	decides whether the difference is real; a regression needs to be both past the threshold and significant.
+	"""
+	rows = []
+	for name, cand in candidates:
+		for config, stages in baseline['results'].items():
+			if config not in cand['results']:
+				continue
+			for stage, base in stages.items():
+				if stage in excluded or stage not in cand['results'][config]:
+					continue
+				new = cand['results'][config][stage]
+				delta = (new - base) / base * 100 if base > 0 else 0.0
+				test = welch_test(
+					baseline.get('samples', {}).get(config, {}).get(stage, []),
+					cand.get('samples', {}).get(config, {}).get(stage, []),
+				)
+				significant = test['significant'] if test is not None else None
+				status = 'ok'
+				if abs(delta) > args.threshold and significant is not False:
+					status = 'regression' if delta > 0 else 'improvement'
+				rows.append({
+					'candidate': name,
+					'config': config,
+					'stage': stage,
+					'baseline': base,
+					'value': new,
+					'delta': delta,
+					'significant': significant,
+					'status': status,
+				})
+	return rows
+
+def format_markdown(rows: list[dict]) -> str:
+	lines = [
+		'| Candidate | Config | Stage | Baseline (s) | Candidate (s) | Delta | Significant | Status |',
+		'|---|---|---|---:|---:|---:|---|---|',
+	]
+	for r in rows:
+		sig = 'n/a' if r['significant'] is None else ('yes' if r['significant'] else 'no')
+		status = f'**{r["status"]}**' if r['status'] == 'regression' else r['status']
+		lines.append(f'| {r["candidate"]} | {r["config"]} | {r["stage"]} | {r["baseline"]:.2f} | {r["value"]:.2f} | {r["delta"]:+.1f}% | {sig} | {status} |')
+	return '\n'.join(lines) + '\n'
+
+def write_csv(rows: list[dict], path: str):
+	with open(path, 'w', newline='') as fp:
+		w = csv.DictWriter(fp, fieldnames=['candidate', 'config', 'stage', 'baseline', 'value', 'delta', 'significant', 'status'])
+		w.writeheader()
+		w.writerows(rows)
+
+def plot_comparison(rows: list[dict]):
+	fig, xbars = plt.subplots(figsize=(max(6, len(rows) * 0.6), 5))
+
+	candidates = list(dict.fromkeys(r['candidate'] for r in rows))
+	groups = list(dict.fromkeys(f'{r["config"]}\n{r["stage"]}' for r in rows))
+	barpos = np.arange(len(groups))
+	inc = 0.8 / len(candidates)
+
+	for i, c in enumerate(candidates):
+		deltas = {f'{r["config"]}\n{r["stage"]}': r for r in rows if r['candidate'] == c}
+		vals = [deltas[g]['delta'] if g in deltas else 0 for g in groups]
+		colors = ['tab:red' if g in deltas and deltas[g]['status'] == 'regression' else None for g in groups]
+		l = xbars.bar(barpos + inc * (i - (len(candidates) - 1) / 2), vals, inc, label=c)
+		for bar, col in zip(l, colors):
+			if col is not None:
+				bar.set_edgecolor(col)
+				bar.set_linewidth(2)
+		xbars.bar_label(l, fmt='%+.1f%%', padding=1)
+
+	xbars.axhline(args.threshold, linestyle='--', color='tab:red', linewidth=1)
+	xbars.axhline(-args.threshold, linestyle='--', color='tab:green', linewidth=1)
+	xbars.axhline(0, color='black', linewidth=0.5)
+	xbars.set_xticks(barpos, groups)
+	xbars.set_ylabel('Change vs baseline (%)')
+	xbars.set_title('Compile time relative to baseline (red outline: regression)')
+	xbars.legend()
+	finish_plot(fig)
+
+def plot_sweep(res: dict):
+	"""Plot speedup and efficiency against thread count for a compile-map.py --sweep-threads run"""
+	fig, (speedup, efficiency) = plt.subplots(1, 2, figsize=(12, 5))
+
+	for config, sweep in res['sweep'].items():
+		threads = sweep['threads']
+		for stage, st in sweep['stages'].items():
+			l, = speedup.plot(threads, st['speedup'], marker='o', label=f'{config} {stage}')
+			efficiency.plot(threads, [e * 100 for e in st['efficiency']], marker='o', color=l.get_color(), label=f'{config} {stage}')
+			# Mark the knee on both curves
+			k = threads.index(st['knee'])
+			speedup.plot(st['knee'], st['speedup'][k], marker='X', markersize=12, color=l.get_color())
+			efficiency.plot(st['knee'], st['efficiency'][k] * 100, marker='X', markersize=12, color=l.get_color())
+
+	threads = sorted({t for s in res['sweep'].values() for t in s['threads']})
+	speedup.plot(threads, [t / threads[0] for t in threads], linestyle='--', color='gray', label='ideal')
+
+	speedup.set_xlabel('Threads')
+	speedup.set_ylabel('Speedup')
+	speedup.set_xscale('log', base=2)
+	speedup.set_xticks(threads, [str(t) for t in threads])
+	speedup.legend()
+	speedup.set_title('Thread scaling')
+
+	efficiency.set_xlabel('Threads')
+	efficiency.set_ylabel('Parallel efficiency (%)')
+	efficiency.set_xscale('log', base=2)
+	efficiency.set_xticks(threads, [str(t) for t in threads])
+	efficiency.set_ylim(0, 110)
+	efficiency.legend()
+	efficiency.set_title('Parallel efficiency (X marks the knee)')
+
+	finish_plot(fig)
+
+def plot_history(rows: list[dict]):
+	"""Plot each stage's time across benchmark runs, with a moving median to show slow drift"""
+	stages = list(dict.fromkeys(r['stage'] for r in rows if r['stage'] not in excluded))
+	fig, axes = plt.subplots(len(stages), 1, figsize=(10, 3.5 * len(stages)), sharex=True, squeeze=False)
+
+	for ax, stage in zip(axes[:, 0], stages):
+		series = {}
+		for r in rows:
+			if r['stage'] == stage:
+				name = r['config'] if len(r['map']) == 0 else f'{r["map"]}/{r["config"]}'
+				series.setdefault((name, r['machine']), []).append(r)
+		machines = {m for _, m in series.keys()}
+		for (name, machine), rs in series.items():
+			times = [datetime.datetime.fromisoformat(r['timestamp']) for r in rs]
+			medians = [r['median'] for r in rs]
+			label = name if len(machines) == 1 else f'{name} @ {machine}'
+			l, = ax.plot(times, medians, marker='o', linestyle='none', alpha=0.4)
+			ax.plot(times, moving_median(medians, args.window), color=l.get_color(), label=label)
+			# Mark runs where the tool binary changed
+			for prev, r, t in zip(rs, rs[1:], times[1:]):
+				if r['tool'] != prev['tool'] and len(r['tool']) > 0 and len(prev['tool']) > 0:
+					ax.axvline(t, linestyle=':', color=l.get_color(), alpha=0.6)
+		ax.set_ylabel('Time (seconds)')
+		ax.set_title(f'{stage} (moving median of {args.window}, dotted lines mark tool changes)')
+		ax.legend(fontsize='small')
+
+	axes[-1, 0].set_xlabel('Run time')
+	fig.autofmt_xdate()
+	finish_plot(fig)
+
+def history(path: str):
+	store = BenchStore(path)
+	try:
+		for p in args.results:
+			try:
+				n = store.add_results(load_results(p))
+			except (OSError, ValueError) as e:
+				print(f'WARNING: Skipping {p}: {e}')
+				continue
+			print(f'Imported {n} results from {p}')
+		rows = store.query(args.map, args.config, args.stage, args.machine)
+	finally:
+		store.close()
+	if len(rows) == 0:
+		print(f'ERROR: No matching results in {path}')
+		exit(2)
+	plot_history(rows)
+
+def load_results(path: str) -> dict:
+	with open(path, 'r') as fp:
+		return json.load(fp)
+
+def load_comparable(path: str) -> dict:
+	"""Load a results file for --compare, exiting with 2 if it can't be compared so CI can tell it from a regression"""
+	try:
+		res = load_results(path)
+		if not isinstance(res, dict) or not isinstance(res.get('results'), dict):
+			raise ValueError('no compile results in it')
+		if res.get('kind') == 'thread-sweep':
+			raise ValueError('thread sweep results can\'t be compared, plot them instead')
+		for config, stages in res['results'].items():
+			if not isinstance(stages, dict) or not all(isinstance(v, (int, float)) for v in stages.values()):
+				raise ValueError(f'malformed results for config {config}')
+	except (OSError, ValueError) as e:
+		print(f'ERROR: Can\'t compare {path}: {e}')
+		exit(2)
+	return res
 
 def main():
-	with open(args.results, 'r') as fp:
-		plot_results(json.load(fp))
+	if args.output is not None:
+		# Don't need a display to render to a file
+		plt.switch_backend('Agg')
+
+	if args.history is not None:
+		history(args.history if len(args.history) > 0 else os.path.join(get_data_dir(), 'compile-history.sqlite'))
+		return
+
+	if len(args.results) == 0:
+		argparser.error('results files are required unless --history is given')
+
+	if not args.compare:
+		res = load_results(args.results[0])
+		if res.get('kind') == 'thread-sweep':
+			plot_sweep(res)
+		else:
+			plot_results(res)
+		return
+
+	if len(args.results) < 2:
+		print('ERROR: --compare needs a baseline and at least one candidate')
+		exit(2)
+
+	baseline = load_comparable(args.results[0])
+	candidates = [(os.path.basename(p), load_comparable(p)) for p in args.results[1:]]
+	rows = compare_results(baseline, candidates)
+	if len(rows) == 0:
+		print('ERROR: No configs/stages in common with the baseline')
+		exit(2)
+
+	md = format_markdown(rows)
+	sys.stdout.write(md)
+	if args.markdown is not None:
+		with open(args.markdown, 'w') as fp:
+			fp.write(md)
+	if args.csv is not None:
+		write_csv(rows, args.csv)
+	# A table written out means a machine is reading, don't block it on a window
+	tables = args.csv is not None or args.markdown is not None
+	if args.output is not None or not (args.no_show or tables):
+		plot_comparison(rows)
+
+	regressions = [r for r in rows if r['status'] == 'regression']
+	if len(regressions) > 0:
+		print(f'\n{len(regressions)} regressions past {args.threshold}%')
+		exit(1)
 
 if __name__ == '__main__':
 	main()
@@ -3,33 +3,65 @@
 # A lightweight tool for analyzing map contents
 
 import os
+import glob
 import string
 import argparse
+import timeit
+import concurrent.futures
+from concurrent.futures.process import BrokenProcessPool
+from typing import BinaryIO
 from srctools.vmf import VMF
 from srctools.keyvalues import Keyvalues
-from srctools.filesys import FileSystem, VPKFileSystem, RawFileSystem, ZipFileSystem
+from srctools.filesys import FileSystem
 import srctools.filesys as filesystem
 import json
-from utils.steamtools import get_appid_path
+from utils.steamtools import get_appid_paths
+from utils.indexcache import IndexCache, get_mount_stamp
+from utils.cachedir import get_cache_dir
+from utils.vmfscan import scan_vmf
+from utils.bspscan import scan_bsp
+from utils.assetdeps import DependencyResolver
 
-parser = argparse.ArgumentParser(description='Simple tool to check the asset contents of a VMF')
-parser.add_argument('-i', required=True, type=str, help='Path to the map file')
+parser = argparse.ArgumentParser(description='Simple tool to check the asset contents of a VMF or BSP')
+parser.add_argument('-i', required=True, type=str, nargs='+', action='extend', help='Paths to map files (.vmf or .bsp), directories of maps or glob patterns. All maps share a single filesystem')
+parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of maps to parse in parallel. Workers only send asset counts back')
 parser.add_argument('--textures', '-t', default=True, action='store_true', dest='textures', help='Check textures')
 parser.add_argument('--models', '-m', action='store_true', dest='models', help='Check models')
 parser.add_argument('--entities', '-e', action='store_true', dest='ents', help='List entities')
-parser.add_argument('-c', '--count', action='store_true', dest='count', help='Display counts next to the asset path')
+parser.add_argument('-c', '--count', action='store_true', dest='count', help='Display counts next to the asset path. Materials are counted per brush side, for BSPs only the sides left after compiling')
 parser.add_argument('-p', '--path', nargs=1, action='append', dest='paths', help='Search paths to look for assets')
 parser.add_argument('--check', action='store_true', help='Run in check mode, checking if assets can be found')
 parser.add_argument('-l', '--list', action='store_true', dest='list', help='Just display a list of the assets')
 parser.add_argument('-v', '--verbose', action='store_true', dest='verbose', help='Run in chatty mode')
 parser.add_argument('--path-file', type=str, dest='path_file', help='Load paths from a JSON file')
 parser.add_argument('--encoding', type=str, dest='encoding', default='utf-8', help='Use encoding for the map file')
+parser.add_argument('--cache-dir', type=str, dest='cache_dir', help='Directory to store the asset index cache in. Defaults to the user cache directory')
+parser.add_argument('--full-parse', action='store_true', dest='full_parse', help='Build the full VMF object model instead of streaming just the asset keys')
+parser.add_argument('--compare-parsers', action='store_true', dest='compare_parsers', help='Time the streaming scanner against the full VMF parse for each map and check they agree')
+parser.add_argument('--no-cache', action='store_true', dest='no_cache', help='Always rescan mounts instead of using the asset index cache')
+parser.add_argument('--deps', action='store_true', help='Also check everything the materials and models depend on, i.e. the textures a material uses or a model\'s .vvd, .vtx and materials')
 
 class SourceFileSystem:
-	def __init__(self, paths: list[str]):
-		self.fs: list[FileSystem] = []
+	def __init__(self, paths: list[str], verbose: bool = False, cache: IndexCache | None = None):
+		self.mounts: list[str] = []
+		# Filesystems are only opened when needed, VPK directories are expensive to load
+		self._fs: dict[str, FileSystem] = {}
+		self.verbose = verbose
+		self.cache = cache
+		# Casefolded path -> real path, one per mount. Built on first lookup
+		self.indexes: list[dict[str, str]] | None = None
+		self.index: set[str] = set()
 		for p in paths:
-			self.fs.append(filesystem.get_filesystem(p))
+			self.add_mount(p)
+
+	def add_mount(self, path: str):
+		self.mounts.append(path)
+		self.indexes = None
+
+	def get_mount(self, path: str) -> FileSystem:
+		if path not in self._fs:
+			self._fs[path] = filesystem.get_filesystem(path)
+		return self._fs[path]
 
 	def from_file(self, file: str):
 		with open(file, 'r') as fp:
@@ -39,10 +71,13 @@ class SourceFileSystem:
 			"fileDir": os.path.dirname(file)
 		}
 
+		# Resolve every app in one go, rather than going through the Steam library once per entry
+		apps = get_appid_paths([desc['appid'] for desc in self.conf.values() if 'appid' in desc])
+
 		for name, desc in self.conf.items():
 			path = ''
 			if 'appid' in desc:
-				path = get_appid_path(desc['appid'])
+				path = apps[desc['appid']]
 				if path is None:
 					raise FileNotFoundError(f'Unable to find install path for {desc["appid"]}! Is it installed?')
 			else:
@@ -50,116 +85,351 @@ class SourceFileSystem:
 
 			if 'mount' in desc:
 				for m in desc['mount']:
-					self.fs.append(filesystem.get_filesystem(f'{path}/{m}'))
+					self.add_mount(f'{path}/{m}')
 
 	@staticmethod
 	def _get_filename(path: str) -> str:
 		p = path.split('/')
 		return p[len(p)-1]
 
+	@staticmethod
+	def normalize(path: str) -> str:
+		return path.replace('\\', '/').casefold()
+
+	def build_index(self):
+		"""Build the casefolded path index for every mount
+		Loose folders, VPKs and ZIPs are all listed once up front so lookups don't need to touch the mounts again.
+		Listings are reused from the index cache when the mount hasn't changed since it was stored.
+		"""
+		start = timeit.default_timer()
+		self.indexes = []
+		self.index = set()
+		for m in self.mounts:
+			if not os.path.exists(m):
+				print(f'WARNING: Search path {m} does not exist, skipping it')
+				self.indexes.append({})
+				continue
+			files = None
+			stamp = None
+			if self.cache is not None:
+				stamp = get_mount_stamp(m)
+			if stamp is not None:
+				files = self.cache.load(m, stamp)
+				if files is not None and self.verbose:
+					print(f'Loaded {len(files)} files for {m} from cache')
+			if files is None:
+				files = [d.path for d in self.get_mount(m).walk_folder()]
+				if stamp is not None:
+					self.cache.store(m, stamp, files)
+				if self.verbose:
+					print(f'Indexed {len(files)} files in {m}')
+			idx = {self.normalize(f): f for f in files}
+			self.indexes.append(idx)
+			self.index.update(idx.keys())
+		if self.verbose:
+			print(f'Built asset index of {len(self.index)} unique files across {len(self.mounts)} mounts in {timeit.default_timer() - start:.2f}s')
+
 	def file_exists(self, path: str) -> bool:
 		"""Check if a file path exists
 		Handles case insensitivity for you.
 		"""
-		for f in self.fs:
-			# VPK/ZIP is capable of case insensitive compare
-			if isinstance(f, VPKFileSystem) or isinstance(f, ZipFileSystem):
-				try:
-					with f.open_bin(path):
-						return True
-				except:
-					pass
-			else:
-				for d in f.walk_folder():
-					if d.path.casefold() == path.casefold():
-						return True
-		return False
+		if self.indexes is None:
+			self.build_index()
+		return self.normalize(path) in self.index
 
-def main():
-	args = parser.parse_args()
-	
+	def open_bin(self, path: str) -> BinaryIO | None:
+		"""Open a file from the first mount that has it, or None if none do
+		Handles case insensitivity for you.
+		"""
+		if self.indexes is None:
+			self.build_index()
+		key = self.normalize(path)
+		for m, idx in zip(self.mounts, self.indexes):
+			if key in idx:
+				return self.get_mount(m)[idx[key]].open_bin()
+		return None
+
+class MapAssets:
+	"""Asset usage counts gathered from a single map"""
+	def __init__(self, path: str):
+		self.path = path
+		self.textures: dict[str, int] = {}
+		self.models: dict[str, int] = {}
+		self.ents: dict[str, int] = {}
+		# Casefolded paths of the files packed into a BSP, these count as found
+		self.packed: set[str] = set()
+		# Set instead of raising so failures can cross the process pool, not all parser exceptions pickle
+		self.error: str | None = None
+
+
+def expand_inputs(inputs: list[str]) -> list[str]:
+	"""Expand directories and glob patterns into a list of map files"""
+	maps = []
+	for i in inputs:
+		if os.path.isdir(i):
+			maps += sorted(glob.glob(os.path.join(glob.escape(i), '**', '*.vmf'), recursive=True))
+			maps += sorted(glob.glob(os.path.join(glob.escape(i), '**', '*.bsp'), recursive=True))
+		elif glob.has_magic(i):
+			maps += sorted(glob.glob(i, recursive=True))
+		else:
+			maps.append(i)
+	return maps
+
+
+def load_map_full(path: str, encoding: str) -> MapAssets:
 	content = ''
-	with open(args.i, 'r', encoding=args.encoding) as fp:
+	with open(path, 'r', encoding=encoding) as fp:
 		content = fp.read()
-	
+
 	kv = Keyvalues.parse(content)
 	vmf = VMF.parse(kv)
 
-	paths = [x[0] for x in args.paths] if args.paths is not None else []
-	if args.verbose:
-		print(f'Paths: {paths}')
-	fs = SourceFileSystem(paths)
-	fs.from_file(args.path_file)
+	assets = MapAssets(path)
+	textures = assets.textures
+	# Grab list of materials for each brush
+	for brush in vmf.brushes:
+		for side in brush.sides:
+			if side.mat not in textures: textures[side.mat] = 0
+			textures[side.mat] += 1
 
-	exit_code = 0
+	# Also go through the entities for the brush entities
+	for ent in vmf.entities:
+		for side in ent.sides():
+			if side.mat not in textures: textures[side.mat] = 0
+			textures[side.mat] += 1
 
-	textures = {}
-	if args.textures:
-		# Grab list of materials for each brush
-		for brush in vmf.brushes:
-			for side in brush.sides:
-				if side.mat not in textures: textures[side.mat] = 0
-				textures[side.mat] += 1
-
-		# Also go through the entities for the brush entities
-		for ent in vmf.entities:
-			for side in ent.sides():
-				if side.mat not in textures: textures[side.mat] = 0
-				textures[side.mat] += 1
+	# Grab list of models from all of the ents
+	models = assets.models
+	for ent in vmf.entities:
+		for kv in ['model', 'viewmodel', 'worldmodel']:
+			m = ent.get(kv, None)
+			if m is not None:
+				if m not in models: models[m] = 0
+				models[m] += 1
+
+	ents = assets.ents
+	for ent in vmf.entities:
+		c = ent.get('classname')
+		if c is None: continue
+		if c not in ents: ents[c] = 0
+		ents[c] += 1
+
+	return assets
+
+
+def load_map_stream(path: str, encoding: str) -> MapAssets:
+	scanned = scan_vmf(path, encoding)
+	assets = MapAssets(path)
+	assets.textures = scanned.textures
+	assets.models = scanned.models
+	assets.ents = scanned.ents
+	return assets
+
+
+def load_map_bsp(path: str) -> MapAssets:
+	scanned = scan_bsp(path)
+	assets = MapAssets(path)
+	assets.textures = scanned.textures
+	assets.models = scanned.models
+	assets.ents = scanned.ents
+	assets.packed = scanned.packed
+	return assets
+
+
+def is_bsp(path: str) -> bool:
+	return path.lower().endswith('.bsp')
+
+
+def load_map(path: str, encoding: str, full: bool = False) -> MapAssets:
+	if is_bsp(path):
+		return load_map_bsp(path)
+	if full:
+		return load_map_full(path, encoding)
+	return load_map_stream(path, encoding)
 
+
+def scan_map(path: str, encoding: str, full: bool = False) -> MapAssets:
+	try:
+		return load_map(path, encoding, full)
+	except Exception as e:
+		assets = MapAssets(path)
+		assets.error = str(e)
+		return assets
+
+
+def print_counts(items: dict[str, int], count: bool):
+	for name, c in items.items():
+		if count:
+			print('{:5d} {:s}'.format(c, name))
+		else:
+			print('{:s}'.format(name))
+
+
+def print_chains(chains: list[list[str]], missing: list[str]):
+	for c in chains:
+		chain = ' -> '.join(c)
+		print(f'missing {chain}')
+		missing.append(chain)
+
+
+def check_map(assets: MapAssets, fs: SourceFileSystem, args, deps: DependencyResolver | None = None) -> list[str]:
+	"""Print the requested report for a map, returning the list of missing assets
+	With a dependency resolver, anything missing further down is reported as the chain of files leading to it.
+	"""
+	missing = []
+	packed = assets.packed
+	if args.textures:
 		if args.list:
-			for tex, count in textures.items():
-				if args.count:
-					print('{:5d} {:s}'.format(count, tex))
-				else:
-					print('{:s}'.format(tex))
+			print_counts(assets.textures, args.count)
 		else:
-			for tex in textures.keys():
-				if not fs.file_exists(f'materials/{tex}.vmt'):
+			for tex in assets.textures.keys():
+				vmt = f'materials/{tex}.vmt'
+				if fs.normalize(vmt) in packed:
+					# Packed materials (i.e. cubemap patches) are found, but their dependencies aren't followed
+					if args.verbose:
+						print(f'packed {tex}')
+					continue
+				if not fs.file_exists(vmt):
 					print(f'missing {tex}')
-					exit_code = 1
-				elif args.verbose:
+					missing.append(tex)
+					continue
+				# Before the chains, which are things missing below it
+				if args.verbose:
 					print(f'found {tex}')
-	
-	models = {}
-	if args.models:
-		# Grab list of models from all of the ents
-		for ent in vmf.entities:
-			for kv in ['model', 'viewmodel', 'worldmodel']:
-				m = ent.get(kv, None)
-				if m is not None:
-					if m not in models: models[m] = 0
-					models[m] += 1
+				if deps is not None:
+					print_chains(deps.resolve(vmt), missing)
 
+	if args.models:
 		if args.list:
-			for model, count in models.items():
-				if args.count:
-					print('{:5d} {:s}'.format(count, model))
-				else:
-					print('{:s}'.format(model))
+			print_counts(assets.models, args.count)
 		else:
-			for model in models.keys():
+			for model in assets.models.keys():
+				if fs.normalize(model) in packed:
+					if args.verbose:
+						print(f'packed {model}')
+					continue
 				if not fs.file_exists(f'{model}'):
 					print(f'missing {model}')
-					exit_code = 1
-				elif args.verbose:
+					missing.append(model)
+					continue
+				# Before the chains, which are things missing below it
+				if args.verbose:
 					print(f'found {model}')
+				if deps is not None:
+					print_chains(deps.resolve(model), missing)
 
-	ents = {}
 	if args.ents and args.list:
-		for ent in vmf.entities:
-			c = ent.get('classname')
-			if c is None: continue
-			if c not in ents: ents[c] = 0
-			ents[c] += 1
-
-		for e, c in ents.items():
-			if args.count:
-				print('{:5d} {:s}'.format(c, e))
-			else:
-				print('{:s}'.format(e))
+		print_counts(assets.ents, args.count)
+
+	return missing
+
+
+def compare_parsers(maps: list[str], encoding: str) -> int:
+	"""Benchmark the streaming scanner against the full parse, returning the number of maps where they disagree"""
+	# Only VMFs have two parsers to compare
+	maps = [m for m in maps if not is_bsp(m)]
+	mismatches = 0
+	total_full = 0.0
+	total_stream = 0.0
+	for m in maps:
+		start = timeit.default_timer()
+		full = load_map_full(m, encoding)
+		t_full = timeit.default_timer() - start
+
+		start = timeit.default_timer()
+		stream = load_map_stream(m, encoding)
+		t_stream = timeit.default_timer() - start
+
+		total_full += t_full
+		total_stream += t_stream
+		same = full.textures == stream.textures and full.models == stream.models and full.ents == stream.ents
+		if not same:
+			mismatches += 1
+		size = os.path.getsize(m) / (1024 * 1024)
+		print(f'{m} ({size:.1f} MiB): full {t_full:.3f}s, stream {t_stream:.3f}s, {t_full / max(t_stream, 1e-9):.1f}x{"" if same else ", MISMATCH"}')
+
+	if len(maps) > 1:
+		print(f'Total: full {total_full:.3f}s, stream {total_stream:.3f}s, {total_full / max(total_stream, 1e-9):.1f}x')
+	return mismatches
+
+
+def main():
+	args = parser.parse_args()
+
+	maps = expand_inputs(args.i)
+	if len(maps) == 0:
+		print(f'ERROR: No maps found in {args.i}')
+		exit(1)
+
+	if args.compare_parsers:
+		exit(1 if compare_parsers(maps, args.encoding) > 0 else 0)
+
+	# The filesystem is shared between every map in the batch
+	paths = [x[0] for x in args.paths] if args.paths is not None else []
+	if args.verbose:
+		print(f'Paths: {paths}')
+	cache = None
+	if not args.no_cache:
+		cache_dir = args.cache_dir if args.cache_dir is not None else get_cache_dir()
+		cache = IndexCache(os.path.join(cache_dir, 'map-check-index.sqlite'))
+	fs = SourceFileSystem(paths, args.verbose, cache)
+	if args.path_file is not None:
+		fs.from_file(args.path_file)
+	# Shared across the batch too, so each material or model is only followed the first time any map uses it
+	deps = DependencyResolver(fs.file_exists, fs.open_bin, fs.normalize) if args.deps else None
+
+	batch = len(maps) > 1
+	missing: dict[str, list[str]] = {}
+	per_map: dict[str, int] = {}
+	failed = []
+	pool = None
+	if args.jobs > 1 and batch:
+		# Each worker returns a MapAssets, never the VMF itself, so memory and pickling stay small
+		pool = concurrent.futures.ProcessPoolExecutor(max_workers=min(args.jobs, len(maps)))
+		results = [pool.submit(scan_map, m, args.encoding, args.full_parse) for m in maps]
+	else:
+		results = [None] * len(maps)
+
+	for m, r in zip(maps, results):
+		if batch:
+			print(f'== {m}')
+		try:
+			assets = r.result() if r is not None else scan_map(m, args.encoding, args.full_parse)
+		except BrokenProcessPool as e:
+			# A worker died outright, i.e. killed for running out of memory. Every map it hadn't finished goes with it
+			print(f'ERROR: Failed to parse {m}: worker process died ({e})')
+			failed.append(m)
+			continue
+		if assets.error is not None:
+			print(f'ERROR: Failed to parse {m}: {assets.error}')
+			failed.append(m)
+			continue
+		map_missing = check_map(assets, fs, args, deps)
+		per_map[m] = len(map_missing)
+		for a in map_missing:
+			if a not in missing: missing[a] = []
+			missing[a].append(m)
+
+	if pool is not None:
+		pool.shutdown()
+
+	if batch:
+		print(f'\n== Checked {len(maps)} maps')
+		if len(failed) > 0:
+			print(f'{len(failed)} maps failed to parse')
+		if not args.list:
+			for m, c in per_map.items():
+				if c > 0:
+					print(f'{c:5d} missing in {m}')
+			print(f'{len(missing)} unique missing assets')
+			for a, ms in missing.items():
+				print('{:5d} {:s}'.format(len(ms), a))
+
+	if deps is not None:
+		for a, e in deps.errors.items():
+			print(f'WARNING: Could not read dependencies of {a}: {e}')
 
-	exit(exit_code)
+	exit(1 if len(missing) > 0 or len(failed) > 0 else 0)
 
 
 if __name__ == '__main__':
@@ -7,13 +7,73 @@ For example, if I want to copy in p2ce's bin, p2ce/bin and platform directories
 
   ./scripts/sync-game.py -a 440000 -o path/to/mymod -d p2ce/bin -d platform -d bin
 
+Only files whose size or modification time differ from the copy in 'mymod' are copied. Add --checksum to
+compare file contents instead, and --delete to remove files from 'mymod' that are no longer in the game.
 To first delete these directories from 'mymod' before copying, add the -c parameter.
 
+Files are copied on several threads (-j). When 'mymod' is only ever read from, --reflink or --hardlink avoid
+duplicating the data at all. Reflinks need a copy-on-write filesystem (Btrfs, XFS, APFS); hard links need
+both dirs on the same filesystem. Both fall back to a regular copy where they can't be used.
+
+Every synced dir gets a manifest in 'mymod/.sync-manifests' listing the size and mtime of its files.
+The next sync skips files whose size and mtime in the game still match it without looking at 'mymod' at
+all, so only the game's files are stat'ed. Use --checksum if files in 'mymod' might have been edited or
+deleted since. Add --hash to also record a hash of every file, then check 'mymod' against its
+manifests, for example in CI:
+
+  ./scripts/sync-game.py -o path/to/mymod --verify
+
+Without hashes, --verify can only check each file's size and mtime.
+
 """
 
 import argparse
 import shutil
+import timeit
+import multiprocessing
 from utils.steamtools import *
+from utils.filesync import SyncPlan, plan_tree, plan_file, apply_plan, describe_plan, format_size, \
+	manifest_path, load_manifest, build_manifest, write_manifest, verify_manifest, check_algorithm
+
+def verify(outpath: str, dirs: list[str], jobs: int, extra: bool) -> int:
+	"""Check synced dirs against their manifests, all of them if no dirs are given. Returns the exit code"""
+	paths = [manifest_path(outpath, d) for d in dirs]
+	if len(paths) == 0:
+		mdir = os.path.join(outpath, '.sync-manifests')
+		if os.path.isdir(mdir):
+			paths = [os.path.join(mdir, f) for f in sorted(os.listdir(mdir)) if f.endswith('.json')]
+	if len(paths) == 0:
+		print(f'ERROR: No sync manifests found in {outpath}')
+		return 1
+
+	start = timeit.default_timer()
+	failed = False
+	nfiles = 0
+	nbytes = 0
+	for p in paths:
+		m = load_manifest(p)
+		if m is None:
+			print(f'ERROR: Missing or unreadable manifest {p}')
+			failed = True
+			continue
+		d = m['dir']
+		try:
+			if m['algorithm'] is not None:
+				check_algorithm(m['algorithm'])
+		except RuntimeError as e:
+			print(f'ERROR: Can\'t verify {d}: {e}')
+			failed = True
+			continue
+		problems = verify_manifest(os.path.join(outpath, d), m, jobs, extra)
+		nfiles += len(m['files'])
+		nbytes += sum(e['size'] for e in m['files'].values())
+		for pr in problems:
+			print(f'  {d}: {pr}')
+		print(f'{"FAILED" if len(problems) > 0 else "OK"} {d}: {len(m["files"])} files, {len(problems)} problems')
+		failed |= len(problems) > 0
+	elapsed = timeit.default_timer() - start
+	print(f'\nVerified {nfiles} files ({format_size(nbytes)}) in {elapsed:.1f}s ({format_size(nbytes / max(elapsed, 1e-6))}/s)')
+	return 1 if failed else 0
 
 def main():
 	parser = argparse.ArgumentParser(usage="""
@@ -24,15 +84,37 @@ Will copy in files from p2ce. The resulting layout will look like:
 <p2ce-dir>/p2ce   ->     <out-dir>/p2ce
 """)
 	# NOTE: Using action=append instead of nargs='+' because python is stupid.
-	parser.add_argument('-a', '--appid', type=int, required=True, help='AppID to copy files from')
+	parser.add_argument('-a', '--appid', type=int, help='AppID to copy files from. Required unless verifying')
 	parser.add_argument('-d', '--dir', action='append', help='List of directorys to copy from within the AppID.')
 	parser.add_argument('-f', '--file', action='append', help='Copy in a single file from the AppID')
 	parser.add_argument('-o', '--out-dir', dest='OUT', type=str, required=True, help='Output directory')
 	parser.add_argument('-c', '--clean', action='store_true', help='Delete destination dirs before copy. WARNING: This may delete your data!!!')
+	parser.add_argument('--checksum', action='store_true', help='Compare file contents instead of size and modification time. Slower, but catches everything')
+	parser.add_argument('--delete', action='store_true', help='Remove files from the destination dirs that are not in the AppID')
+	parser.add_argument('-j', '--jobs', type=int, default=min(8, multiprocessing.cpu_count()), help='Number of files to copy at once')
+	mode = parser.add_mutually_exclusive_group()
+	mode.add_argument('--reflink', action='store_const', dest='mode', const='reflink', default='copy', help='Share file data with the AppID on copy-on-write filesystems instead of copying it')
+	mode.add_argument('--hardlink', action='store_const', dest='mode', const='hardlink', help='Hard link files to the AppID instead of copying. Never edit the synced files!')
+	parser.add_argument('--no-manifest', action='store_true', dest='no_manifest', help='Don\'t read or write sync manifests')
+	parser.add_argument('--hash', action='store_true', help='Record a hash of every file in the manifest for --verify. Reads back everything that was copied')
+	parser.add_argument('--verify', action='store_true', help='Check the output dirs against their manifests instead of syncing. Checks every synced dir if no -d is given')
+	parser.add_argument('--extra', action='store_true', help='With --verify, also report files that are not in the manifest')
 	parser.add_argument('-v', dest='VERBOSE', action='store_true', help='Run extra verbose-ly')
 	parser.add_argument('--dry-run', action='store_true', dest='DRY', help='Dont actually copy or remove, just display the operations')
 	args = parser.parse_args()
 
+	outpath = os.path.abspath(args.OUT)
+	if not os.path.exists(outpath):
+		print(f'ERROR: Output path "{outpath}" does not exist')
+		exit(1)
+
+	if args.verify:
+		exit(verify(outpath, args.dir if args.dir is not None else [], args.jobs, args.extra))
+
+	if args.appid is None:
+		print('ERROR: need an AppID to copy from with -a')
+		exit(1)
+
 	# Need at least one dir or file
 	if args.dir is None and args.file is None:
 		print(f'ERROR: need at least one dir or file with -f/-d')
@@ -41,11 +123,6 @@ Will copy in files from p2ce. The resulting layout will look like:
 	if args.dir is None: args.dir = []
 	if args.file is None: args.file = []
 
-	outpath = os.path.abspath(args.OUT)
-	if not os.path.exists(outpath):
-		print(f'ERROR: Output path "{outpath}" does not exist')
-		exit(1)
-
 	apppath = get_appid_path(args.appid)
 	if apppath is None:
 		print(f'ERROR: Unable to find install directory for {args.appid}')
@@ -70,32 +147,44 @@ Will copy in files from p2ce. The resulting layout will look like:
 			try:
 				if not args.DRY:
 					shutil.rmtree(f'{outpath}/{d}')
+					if os.path.exists(manifest_path(outpath, d)):
+						os.remove(manifest_path(outpath, d))
 				print(f'Cleaned {outpath}/{d}')
 			except Exception as e:
 				print(f'WARNING: Unable to remove {outpath}/{d}: {e}')
 
-	# Copy in the dirs
+	# Copy in whatever changed
+	start = timeit.default_timer()
+	total = SyncPlan()
 	for d in args.dir:
 		try:
-			if not args.DRY:
-				os.makedirs(f'{outpath}/{d}', exist_ok=True)
-				shutil.copytree(f'{apppath}/{d}', f'{outpath}/{d}', dirs_exist_ok=True)
+			mpath = manifest_path(outpath, d)
+			previous = load_manifest(mpath) if not args.no_manifest else None
+			plan = plan_tree(f'{apppath}/{d}', f'{outpath}/{d}', args.checksum, args.delete, previous)
+			apply_plan(plan, args.DRY, args.VERBOSE, args.jobs, args.mode)
+			if not args.DRY and not args.no_manifest:
+				manifest = build_manifest(f'{apppath}/{d}', f'{outpath}/{d}', plan, previous, args.jobs, args.hash)
+				manifest['dir'] = d
+				write_manifest(mpath, manifest)
 		except Exception as e:
 			print(f'ERROR: Failed to copy {apppath}/{d} to {outpath}/{d}: {e}')
 			exit(1)
-		print(f'Copied {apppath}/{d} -> {outpath}/{d}')
+		print(f'Synced {apppath}/{d} -> {outpath}/{d}: {describe_plan(plan)}')
+		total.extend(plan)
 
 	# Copy in the individual files
 	for f in args.file:
 		try:
-			if not args.DRY:
-				os.makedirs(f'{outpath}/{os.path.dirname(f)}', exist_ok=True)
-				shutil.copy(f'{apppath}/{f}', f'{outpath}/{f}')
+			plan = plan_file(f'{apppath}/{f}', f'{outpath}/{f}', args.checksum)
+			apply_plan(plan, args.DRY, args.VERBOSE, args.jobs, args.mode)
 		except Exception as e:
 			print(f'ERROR: Failed to copy {apppath}/{f} to {outpath}/{f}: {e}')
 			exit(1)
-		print(f'Copied {apppath}/{f} -> {outpath}/{d}')
+		print(f'{"Copied" if len(plan.copies) > 0 else "Unchanged"} {apppath}/{f} -> {outpath}/{f}')
+		total.extend(plan)
 
+	elapsed = timeit.default_timer() - start
+	print(f'\nTotal: {describe_plan(total)} in {elapsed:.1f}s ({format_size(total.copy_bytes / max(elapsed, 1e-6))}/s)')
 	print(f'\nAll done!')
 
 if __name__ == '__main__':
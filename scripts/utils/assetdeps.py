@@ -0,0 +1,215 @@
+import struct
+from typing import BinaryIO, Callable
+from srctools.keyvalues import Keyvalues, KeyValError
+
+# Material parameters that name a texture
+TEXTURE_PARAMS = {
+	'$basetexture', '$basetexture2', '$basetexture3', '$basetexture4', '$hdrbasetexture', '$hdrcompressedtexture',
+	'$bumpmap', '$bumpmap2', '$normalmap', '$normalmap2', '$basenormalmap', '$basenormalmap2',
+	'$detail', '$detail2', '$envmap', '$envmapmask', '$envmapmask2', '$selfillummask', '$selfillumtexture',
+	'$blendmodulatetexture', '$mraotexture', '$emissiontexture', '$phongexponenttexture', '$phongwarptexture',
+	'$lightwarptexture', '$ambientoccltexture', '$iris', '$corneatexture', '$flowmap', '$flow_noise_texture',
+	'$dudvmap', '$refracttexture', '$tintmasktexture', '$texture2', '$parallaxmap', '$specmasktexture',
+}
+
+# Material parameters that name another material
+MATERIAL_PARAMS = {'$bottommaterial', '$underwateroverlay'}
+
+# Texture names the engine provides itself
+ENGINE_TEXTURES = ('_rt_', 'env_cubemap', '[')
+
+# Offsets into studiohdr_t, shared by MDL versions 44 to 49
+MDL_HEADER = struct.Struct('<4si')
+MDL_TEXTURES = struct.Struct('<iiii')		# numtextures, textureindex, numcdtextures, cdtextureindex
+MDL_TEXTURES_OFFSET = 204
+MDL_BODYPARTS = struct.Struct('<i')			# numbodyparts
+MDL_BODYPARTS_OFFSET = 232
+# sizeof(mstudiotexture_t), the name offset is its first member and relative to the struct
+MDL_TEXTURE_SIZE = 64
+
+# Compiled mesh files, any one of these will do
+VTX_EXTENSIONS = ['.dx90.vtx', '.dx80.vtx', '.sw.vtx', '.vtx']
+
+
+def _read_string(data: bytes, offset: int) -> str:
+	end = data.index(b'\0', offset)
+	return data[offset:end].decode('utf-8', errors='replace')
+
+
+def _texture_path(name: str) -> str:
+	name = name.replace('\\', '/').strip('/')
+	if name.lower().startswith('materials/'):
+		name = name[len('materials/'):]
+	if name.lower().endswith('.vtf'):
+		name = name[:-4]
+	return f'materials/{name}.vtf'
+
+
+def _material_path(name: str) -> str:
+	return _texture_path(name)[:-4] + '.vmt'
+
+
+class DependencyResolver:
+	"""
+	Follows the files an asset needs, and the files those need, reporting any that can't be found
+
+	Materials depend on the textures and materials named in their parameters and on the material a patch
+	includes. Models depend on their .vvd, a .vtx and every material they use, searched for in each of
+	their cdmaterials folders. A .phy is only needed by some models, so its absence isn't reported.
+
+	Each asset is resolved once, so a material shared by thousands of brushes across many maps is only
+	read and parsed the first time it's seen. Assets in an include loop are the exception: until the loop's
+	first asset is done, what's found below the others is missing whatever lies past that first asset, so
+	they are only kept once resolved outside the loop.
+
+	Parameters
+	----------
+	exists: Callable[[str], bool]
+		Whether a game path exists
+	open_bin: Callable[[str], BinaryIO|None]
+		Opens a game path for reading, None if it doesn't exist
+	normalize: Callable[[str], str]
+		Maps a game path to its cache key, should match how exists handles case
+	"""
+	def __init__(self, exists: Callable[[str], bool], open_bin: Callable[[str], BinaryIO | None], normalize: Callable[[str], str] = str.casefold):
+		self.exists = exists
+		self.open_bin = open_bin
+		self.normalize = normalize
+		# Asset -> chains of missing files below it
+		self._closure: dict[str, list[list[str]]] = {}
+		# Assets currently being resolved and how deep in the chain each is, to stop include loops
+		self._active: dict[str, int] = {}
+		# Assets that exist but couldn't be read, and why
+		self.errors: dict[str, str] = {}
+
+	def resolve(self, path: str) -> list[list[str]]:
+		"""
+		Find everything missing below an asset
+
+		Parameters
+		----------
+		path: str
+			Game path of the asset, i.e. materials/foo/bar.vmt or models/foo.mdl
+
+		Returns
+		-------
+		list[list[str]]
+			One chain per missing file, leading from path down to the file that's missing. Empty if nothing is missing
+		"""
+		return self._resolve(path)[0]
+
+	def _resolve(self, path: str) -> tuple[list[list[str]], int | None]:
+		"""resolve, along with the depth of the shallowest asset still being resolved that path loops back to, if any"""
+		key = self.normalize(path)
+		if key in self._closure:
+			# Start the chains with the path as this caller spelled it
+			return [[path] + c[1:] for c in self._closure[key]], None
+		if key in self._active:
+			return [], self._active[key]
+
+		if not self.exists(path):
+			self._closure[key] = [[path]]
+			return [[path]], None
+
+		depth = len(self._active)
+		self._active[key] = depth
+		loop = None
+		try:
+			chains = []
+			for dep in self.dependencies(path):
+				sub, l = self._resolve(dep)
+				if l is not None and (loop is None or l < loop):
+					loop = l
+				for c in sub:
+					# A chain back through path is a longer way to something path's own chains already reach
+					if not any(self.normalize(p) == key for p in c):
+						chains.append([path] + c)
+		finally:
+			del self._active[key]
+		if loop is not None and loop < depth:
+			# Part of a loop that started further up, so this isn't everything below it yet
+			return chains, loop
+		self._closure[key] = chains
+		return list(chains), None
+
+	def dependencies(self, path: str) -> list[str]:
+		"""Files an asset directly refers to"""
+		lower = path.lower()
+		try:
+			if lower.endswith('.vmt'):
+				return self._material_deps(path)
+			if lower.endswith('.mdl'):
+				return self._model_deps(path)
+		except (KeyValError, ValueError, struct.error) as e:
+			self.errors[path] = str(e)
+		return []
+
+	def _read(self, path: str) -> bytes | None:
+		fp = self.open_bin(path)
+		if fp is None:
+			return None
+		with fp:
+			return fp.read()
+
+	def _material_deps(self, path: str) -> list[str]:
+		data = self._read(path)
+		if data is None:
+			return []
+		kv = Keyvalues.parse(data.decode('utf-8', errors='replace'), path)
+		deps = []
+		for shader in kv:
+			if not shader.has_children():
+				continue
+			if shader.name == 'patch' and 'include' in shader:
+				deps.append(shader['include'].replace('\\', '/'))
+			self._collect_params(shader, deps)
+		return list(dict.fromkeys(deps))
+
+	def _collect_params(self, block: Keyvalues, deps: list[str]):
+		for kv in block:
+			if kv.has_children():
+				# Fallback and patch blocks hold parameters too, proxies don't name files
+				if kv.name != 'proxies':
+					self._collect_params(kv, deps)
+				continue
+			value = kv.value.strip()
+			if len(value) == 0 or value.lower().startswith(ENGINE_TEXTURES):
+				continue
+			if kv.name in TEXTURE_PARAMS:
+				deps.append(_texture_path(value))
+			elif kv.name in MATERIAL_PARAMS:
+				deps.append(_material_path(value))
+
+	def _model_deps(self, path: str) -> list[str]:
+		data = self._read(path)
+		if data is None:
+			return []
+		ident, version = MDL_HEADER.unpack_from(data, 0)
+		if ident != b'IDST':
+			raise ValueError(f'not a studio model ({ident!r})')
+
+		base = path[:-4]
+		deps = []
+		(numbodyparts,) = MDL_BODYPARTS.unpack_from(data, MDL_BODYPARTS_OFFSET)
+		if numbodyparts > 0:
+			deps.append(f'{base}.vvd')
+			vtx = next((f'{base}{ext}' for ext in VTX_EXTENSIONS if self.exists(f'{base}{ext}')), None)
+			deps.append(vtx if vtx is not None else f'{base}{VTX_EXTENSIONS[0]}')
+
+		numtextures, textureindex, numcdtextures, cdtextureindex = MDL_TEXTURES.unpack_from(data, MDL_TEXTURES_OFFSET)
+		cdmaterials = []
+		for i in range(numcdtextures):
+			(offset,) = struct.unpack_from('<i', data, cdtextureindex + i * 4)
+			d = _read_string(data, offset).replace('\\', '/').strip('/')
+			cdmaterials.append(f'{d}/' if len(d) > 0 else '')
+		if len(cdmaterials) == 0:
+			cdmaterials.append('')
+
+		for i in range(numtextures):
+			tex = textureindex + i * MDL_TEXTURE_SIZE
+			(nameindex,) = struct.unpack_from('<i', data, tex)
+			name = _read_string(data, tex + nameindex).replace('\\', '/')
+			# The engine uses the first cdmaterials folder the material turns up in
+			candidates = [_material_path(f'{cd}{name}') for cd in cdmaterials]
+			deps.append(next((c for c in candidates if self.exists(c)), candidates[0]))
+		return deps
@@ -0,0 +1,95 @@
+import math
+import statistics
+
+# Two-sided 95% critical values of Student's t distribution, indexed by degrees of freedom
+_T95 = [
+	None, 12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365, 2.306, 2.262, 2.228,
+	2.201, 2.179, 2.160, 2.145, 2.131, 2.120, 2.110, 2.101, 2.093, 2.086,
+	2.080, 2.074, 2.069, 2.064, 2.060, 2.056, 2.052, 2.048, 2.045, 2.042,
+]
+
+
+def t_critical(df: float) -> float:
+	"""
+	Returns the two-sided 95% critical value of the t distribution
+
+	Parameters
+	----------
+	df: float
+		Degrees of freedom. Fractional values (from Welch's approximation) are rounded down
+
+	Returns
+	-------
+	float
+		Critical value, falling back to the normal approximation past 30 degrees of freedom
+	"""
+	df = int(df)
+	if df < 1:
+		return math.inf
+	if df < len(_T95):
+		return _T95[df]
+	return 1.96
+
+
+def summarize(samples: list[float]) -> dict:
+	"""
+	Computes summary statistics for a list of timing samples
+
+	Parameters
+	----------
+	samples: list[float]
+		Measured values, at least one
+
+	Returns
+	-------
+	dict
+		n, min, max, median, mean, stddev and the 95% confidence interval of the mean as [low, high].
+		stddev and the interval are None with fewer than two samples
+	"""
+	n = len(samples)
+	mean = statistics.fmean(samples)
+	out = {
+		'n': n,
+		'min': min(samples),
+		'max': max(samples),
+		'median': statistics.median(samples),
+		'mean': mean,
+		'stddev': None,
+		'ci95': None,
+	}
+	if n > 1:
+		sd = statistics.stdev(samples)
+		half = t_critical(n - 1) * sd / math.sqrt(n)
+		out['stddev'] = sd
+		out['ci95'] = [mean - half, mean + half]
+	return out
+
+
+def welch_test(a: list[float], b: list[float]) -> dict | None:
+	"""
+	Welch's unequal-variance t-test between two sets of samples
+
+	Parameters
+	----------
+	a: list[float]
+		Baseline samples
+	b: list[float]
+		Candidate samples
+
+	Returns
+	-------
+	dict|None
+		t statistic, degrees of freedom and whether the difference in means is significant at 95%.
+		None if either side has fewer than two samples
+	"""
+	if len(a) < 2 or len(b) < 2:
+		return None
+	va = statistics.variance(a) / len(a)
+	vb = statistics.variance(b) / len(b)
+	diff = statistics.fmean(b) - statistics.fmean(a)
+	if va + vb == 0:
+		# No noise at all, any difference is real
+		return {'t': math.inf if diff != 0 else 0.0, 'df': len(a) + len(b) - 2, 'significant': diff != 0}
+	t = diff / math.sqrt(va + vb)
+	df = (va + vb) ** 2 / (va ** 2 / (len(a) - 1) + vb ** 2 / (len(b) - 1))
+	return {'t': t, 'df': df, 'significant': abs(t) > t_critical(df)}
@@ -0,0 +1,148 @@
+import json
+import sqlite3
+import statistics
+
+
+class BenchStore:
+	"""
+	Time-series store of compile benchmark results
+
+	Every benchmark run adds one row per map, config and stage with the median time and the individual
+	samples, tagged with the machine it ran on and the hash of the tool binary. Trends can then be
+	pulled out per stage over any number of runs.
+	"""
+	def __init__(self, path: str):
+		self.path = path
+		self.db = sqlite3.connect(path)
+		with self.db:
+			self.db.execute('''CREATE TABLE IF NOT EXISTS results (
+				timestamp TEXT NOT NULL,
+				map TEXT NOT NULL,
+				config TEXT NOT NULL,
+				stage TEXT NOT NULL,
+				machine TEXT NOT NULL,
+				tool TEXT NOT NULL,
+				median REAL NOT NULL,
+				samples TEXT NOT NULL,
+				settings TEXT NOT NULL
+			)''')
+			self.db.execute('CREATE INDEX IF NOT EXISTS results_series ON results (map, config, stage, machine, timestamp)')
+
+	@staticmethod
+	def machine_key(machine: dict) -> str:
+		"""Identifies a machine by host name and CPU, so a hardware swap starts a new series"""
+		return f'{machine.get("hostname", "")} ({machine.get("cpu", "")})'
+
+	def add_results(self, outs: dict) -> int:
+		"""
+		Append a compile-map results dict to the store
+
+		Parameters
+		----------
+		outs: dict
+			Results as written by compile-map --bench (version 2 or later)
+
+		Returns
+		-------
+		int
+			Number of rows added, 0 if these results were already stored
+
+		Raises
+		------
+		ValueError
+			If outs isn't a version 2 or later --bench results file, e.g. a thread sweep or an older file without timestamps
+		"""
+		if outs.get('kind') == 'thread-sweep':
+			raise ValueError('thread sweep results have no history to record')
+		if outs.get('version', 1) < 2 or 'timestamp' not in outs or not isinstance(outs.get('results'), dict):
+			raise ValueError(f'results version {outs.get("version", 1)} is too old, version 2 or later is needed')
+		machine = self.machine_key(outs.get('machine', {}))
+		# Importing the same results file twice shouldn't double up the history
+		if self.db.execute('SELECT 1 FROM results WHERE timestamp = ? AND machine = ? LIMIT 1', (outs['timestamp'], machine)).fetchone() is not None:
+			return 0
+		settings = json.dumps(outs.get('settings', {}))
+		labels = outs.get('labels', {})
+		rows = []
+		for label, stages in outs['results'].items():
+			# Older files only have the label, which is the config name when a single map was compiled
+			info = labels.get(label, {})
+			mapname = info.get('map', '')
+			config = info.get('config', label)
+			for stage, median in stages.items():
+				samples = outs.get('samples', {}).get(label, {}).get(stage, [median])
+				tool = outs.get('tools', {}).get(label, {}).get(stage, '')
+				rows.append((outs['timestamp'], mapname, config, stage, machine, tool, median, json.dumps(samples), settings))
+		with self.db:
+			self.db.executemany('INSERT INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+		return len(rows)
+
+	def query(self, map: str | None = None, config: str | None = None, stage: str | None = None,
+			  machine: str | None = None) -> list[dict]:
+		"""
+		Fetch stored results in time order, optionally filtered
+
+		Parameters
+		----------
+		map: str|None
+			Only return results for this map
+		config: str|None
+			Only return results for this config
+		stage: str|None
+			Only return results for this stage
+		machine: str|None
+			Only return results from machines whose key contains this string
+
+		Returns
+		-------
+		list[dict]
+			timestamp, map, config, stage, machine, tool, median and samples of every matching result
+		"""
+		where = []
+		params = []
+		for col, v in [('map', map), ('config', config), ('stage', stage)]:
+			if v is not None:
+				where.append(f'{col} = ?')
+				params.append(v)
+		if machine is not None:
+			where.append('instr(machine, ?) > 0')
+			params.append(machine)
+		sql = 'SELECT timestamp, map, config, stage, machine, tool, median, samples FROM results'
+		if len(where) > 0:
+			sql += ' WHERE ' + ' AND '.join(where)
+		sql += ' ORDER BY timestamp'
+		out = []
+		for row in self.db.execute(sql, params):
+			out.append({
+				'timestamp': row[0],
+				'map': row[1],
+				'config': row[2],
+				'stage': row[3],
+				'machine': row[4],
+				'tool': row[5],
+				'median': row[6],
+				'samples': json.loads(row[7]),
+			})
+		return out
+
+	def close(self):
+		self.db.close()
+
+
+def moving_median(values: list[float], window: int) -> list[float]:
+	"""
+	Trailing moving median, so each point only depends on runs up to and including it
+
+	Parameters
+	----------
+	values: list[float]
+		Series in time order
+	window: int
+		Number of points to take the median over. The first few points use however many there are
+
+	Returns
+	-------
+	list[float]
+		One median per input value
+	"""
+	window = max(1, window)
+	return [statistics.median(values[max(0, i - window + 1):i + 1]) for i in range(len(values))]
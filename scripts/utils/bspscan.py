@@ -0,0 +1,243 @@
+import re
+import mmap
+import collections
+import lzma
+import struct
+from srctools.binformat import decompress_lzma
+
+# Entity keys that reference models
+MODEL_KEYS = ['model', 'viewmodel', 'worldmodel']
+
+# Lumps we read, everything else is left untouched
+LUMP_ENTITIES = 0
+LUMP_TEXDATA = 2
+LUMP_TEXINFO = 6
+LUMP_FACES = 7
+LUMP_ORIGINALFACES = 27
+LUMP_GAME_LUMP = 35
+LUMP_PAKFILE = 40
+LUMP_TEXDATA_STRING_DATA = 43
+LUMP_TEXDATA_STRING_TABLE = 44
+LUMP_FACES_HDR = 58
+
+HEADER = struct.Struct('<4si')
+LUMP = struct.Struct('<iiii')
+LUMP_COUNT = 64
+GAME_LUMP = struct.Struct('<4sHHii')
+GAME_LUMP_COMPRESSED = 1
+STATIC_PROP_NAME = 128
+# Only the index each record points through is read, the rest is skipped over
+TEXDATA_NAME = struct.Struct('<12xi16x')	# dtexdata_t.nameStringTableID
+TEXINFO_TEXDATA = struct.Struct('<68xi')	# texinfo_t.texdata
+FACE_TEXINFO = struct.Struct('<10xh44x')	# dface_t.texinfo
+# Every static prop version starts with origin and angles, followed by the prop's index into the model dictionary
+STATIC_PROP_TYPE_OFFSET = 24
+
+# Zip records in the pakfile, see APPNOTE.TXT
+ZIP_END = struct.Struct('<4sHHHHIIH')
+ZIP_END_MAGIC = b'PK\x05\x06'
+ZIP_CENTRAL = struct.Struct('<4s6H3I5H2I')
+ZIP_CENTRAL_MAGIC = b'PK\x01\x02'
+
+ENTITY_PATTERN = re.compile(rb'\{([^{}]*)\}')
+KEYVALUE_PATTERN = re.compile(rb'"([^"]*)"\s*"([^"]*)"')
+
+
+class BSPAssets:
+	"""
+	Asset usage counts gathered by scan_bsp
+	"""
+	def __init__(self):
+		self.textures: dict[str, int] = {}
+		self.models: dict[str, int] = {}
+		self.ents: dict[str, int] = {}
+		# Casefolded paths of every file packed into the map
+		self.packed: set[str] = set()
+
+
+def _count(d: dict[str, int], key: str, n: int = 1):
+	if key not in d: d[key] = 0
+	d[key] += n
+
+
+def _lump(view: memoryview, lumps: list[tuple[int, int, int]], index: int) -> memoryview | bytes:
+	offset, length, uncomp_size = lumps[index]
+	data = view[offset:offset + length]
+	if uncomp_size > 0:
+		# Only lumps saved compressed need copying out of the map
+		return decompress_lzma(bytes(data))
+	return data
+
+
+def _read_lumps(view: memoryview) -> list[tuple[int, int, int]]:
+	ident, version = HEADER.unpack_from(view, 0)
+	if ident != b'VBSP':
+		raise ValueError(f'not a BSP ({bytes(ident)!r})')
+	# L4D2 and later v21 maps put the lump version first. The first lump's offset can never be zero, so use that to tell
+	l4d2 = version == 21 and view[8:12] == b'\0\0\0\0'
+	lumps = []
+	for i in range(LUMP_COUNT):
+		offset, length, lump_version, uncomp_size = LUMP.unpack_from(view, HEADER.size + i * LUMP.size)
+		if l4d2:
+			offset, length = length, lump_version
+		lumps.append((offset, length, uncomp_size))
+	return lumps
+
+
+def _scan_entities(data: memoryview | bytes, assets: BSPAssets):
+	for block in ENTITY_PATTERN.finditer(data):
+		ent = {k.decode('utf-8', errors='replace').casefold(): v.decode('utf-8', errors='replace') for k, v in KEYVALUE_PATTERN.findall(block.group(1))}
+		classname = ent.get('classname')
+		# Match scan_vmf, worldspawn isn't counted as an entity
+		if classname is None or classname == 'worldspawn':
+			continue
+		_count(assets.ents, classname)
+		for key in MODEL_KEYS:
+			m = ent.get(key)
+			# *N is one of the map's own brush models
+			if m is not None and not m.startswith('*'):
+				_count(assets.models, m)
+
+
+def _scan_textures(view: memoryview, lumps: list[tuple[int, int, int]], assets: BSPAssets):
+	# Only a few KiB, quicker to search as bytes
+	strings = bytes(_lump(view, lumps, LUMP_TEXDATA_STRING_DATA))
+	names = []
+	for (offset,) in struct.iter_unpack('<i', _lump(view, lumps, LUMP_TEXDATA_STRING_TABLE)):
+		end = strings.find(b'\0', offset)
+		names.append(strings[offset:end if end >= 0 else None].decode('utf-8', errors='replace'))
+	# Every material is checked, even ones no face uses any more (i.e. overlays, or nodraw once it's stripped)
+	for name in names:
+		assets.textures.setdefault(name, 0)
+
+	# Original faces are the brush sides before the BSP tree split them, the closest thing to a VMF's sides.
+	# Maps without them have only their split faces to go on
+	faces = _lump(view, lumps, LUMP_ORIGINALFACES)
+	if len(faces) == 0:
+		faces = _lump(view, lumps, LUMP_FACES)
+	if len(faces) == 0:
+		faces = _lump(view, lumps, LUMP_FACES_HDR)
+	texdata = [n for (n,) in TEXDATA_NAME.iter_unpack(_lump(view, lumps, LUMP_TEXDATA))]
+	texinfo = [t for (t,) in TEXINFO_TEXDATA.iter_unpack(_lump(view, lumps, LUMP_TEXINFO))]
+	uses = collections.Counter(t for (t,) in FACE_TEXINFO.iter_unpack(faces))
+	for ti, n in uses.items():
+		if 0 <= ti < len(texinfo) and 0 <= texinfo[ti] < len(texdata) and 0 <= texdata[texinfo[ti]] < len(names):
+			_count(assets.textures, names[texdata[texinfo[ti]]], n)
+
+
+def _scan_static_props(view: memoryview, lumps: list[tuple[int, int, int]], assets: BSPAssets):
+	game = _lump(view, lumps, LUMP_GAME_LUMP)
+	if len(game) < 4:
+		return
+	(count,) = struct.unpack_from('<i', game, 0)
+	entries = [GAME_LUMP.unpack_from(game, 4 + i * GAME_LUMP.size) for i in range(count)]
+	for i, (ident, flags, version, offset, length) in enumerate(entries):
+		# IDs are stored backwards
+		if ident != b'prps':
+			continue
+		if flags & GAME_LUMP_COMPRESSED:
+			# Compressed game lumps store their uncompressed size instead, the next entry marks the end
+			end = entries[i + 1][3] if i + 1 < len(entries) else lumps[LUMP_GAME_LUMP][0] + lumps[LUMP_GAME_LUMP][1]
+			data = decompress_lzma(bytes(view[offset:end]))
+		else:
+			data = view[offset:offset + length]
+
+		(num_models,) = struct.unpack_from('<i', data, 0)
+		pos = 4
+		models = []
+		for _ in range(num_models):
+			name = bytes(data[pos:pos + STATIC_PROP_NAME]).split(b'\0', 1)[0]
+			models.append(name.decode('utf-8', errors='replace'))
+			pos += STATIC_PROP_NAME
+		(num_leaves,) = struct.unpack_from('<i', data, pos)
+		pos += 4 + num_leaves * 2
+		(num_props,) = struct.unpack_from('<i', data, pos)
+		pos += 4
+		if num_props == 0:
+			return
+		# The prop struct changes size between versions, but the rest of the lump is just props
+		size = (len(data) - pos) // num_props
+		uses = [0] * len(models)
+		for p in range(num_props):
+			(model,) = struct.unpack_from('<H', data, pos + p * size + STATIC_PROP_TYPE_OFFSET)
+			if model < len(uses):
+				uses[model] += 1
+		for m, n in zip(models, uses):
+			if n > 0:
+				_count(assets.models, m, n)
+		return
+
+
+def _scan_pakfile(data: memoryview | bytes, assets: BSPAssets):
+	if len(data) < ZIP_END.size:
+		return
+	# The end record is at the very end unless the zip has a comment, which pakfiles don't
+	end = bytes(data[-(ZIP_END.size + 0xFFFF):]).rfind(ZIP_END_MAGIC)
+	if end < 0:
+		raise ValueError('pakfile has no zip directory')
+	end += max(len(data) - (ZIP_END.size + 0xFFFF), 0)
+	_, _, _, _, entries, dir_size, _, _ = ZIP_END.unpack_from(data, end)
+	# Some tools write offsets relative to the BSP rather than the lump, so work back from the end record instead
+	pos = end - dir_size
+	for _ in range(entries):
+		fields = ZIP_CENTRAL.unpack_from(data, pos)
+		if fields[0] != ZIP_CENTRAL_MAGIC:
+			raise ValueError('corrupt pakfile directory')
+		name_len, extra_len, comment_len = fields[10], fields[11], fields[12]
+		start = pos + ZIP_CENTRAL.size
+		name = bytes(data[start:start + name_len]).decode('utf-8', errors='replace')
+		assets.packed.add(name.replace('\\', '/').casefold())
+		pos = start + name_len + extra_len + comment_len
+
+
+def scan_bsp(path: str) -> BSPAssets:
+	"""
+	Collects materials, models, entity classnames and packed files from a compiled map
+
+	The map is memory mapped and only the lumps listed above are looked at, in place, so a BSP is never
+	read or copied in full. Only lumps the compiler saved compressed get copied out to be decompressed.
+
+	Materials are counted once per face using them, like scan_vmf counts brush sides. Sides the compiler
+	removes (nodraw, and faces hidden inside other brushes) are gone, so a material can count 0, and
+	overlays and decals aren't counted at all. Models are counted once per static prop and once per
+	entity, brush models (*N) are skipped. Classnames are counted the same as scan_vmf, which leaves out
+	worldspawn, but entities the compiler folds into the map (prop_static, func_detail and the like) are
+	no longer there to count.
+
+	Parameters
+	----------
+	path: str
+		Path to the BSP
+
+	Returns
+	-------
+	BSPAssets
+		Counts for every material, model and classname seen, and the files packed into the map
+	"""
+	assets = BSPAssets()
+	error = None
+	with open(path, 'rb') as fp:
+		mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+		try:
+			view = memoryview(mm)
+			try:
+				lumps = _read_lumps(view)
+				_scan_entities(_lump(view, lumps, LUMP_ENTITIES), assets)
+				_scan_textures(view, lumps, assets)
+				_scan_static_props(view, lumps, assets)
+				_scan_pakfile(_lump(view, lumps, LUMP_PAKFILE), assets)
+			except (ValueError, struct.error, IndexError, lzma.LZMAError) as e:
+				# Only keep the message, the traceback holds slices of the map
+				error = str(e)
+			finally:
+				view.release()
+		finally:
+			try:
+				mm.close()
+			except BufferError:
+				# Slices are still held by an exception on its way out. The mapping is freed along with them,
+				# and the exception itself is what the caller needs to see
+				pass
+	if error is not None:
+		raise ValueError(error)
+	return assets
@@ -0,0 +1,39 @@
+import os
+import sys
+
+
+def get_cache_dir() -> str:
+	"""
+	Returns the per-user cache directory for sdk_tools, creating it if needed
+
+	Returns
+	-------
+	str
+		Path to the cache directory
+	"""
+	if sys.platform.startswith('win'):
+		base = os.getenv('LOCALAPPDATA', os.path.expanduser('~\\AppData\\Local'))
+	else:
+		base = os.getenv('XDG_CACHE_HOME', os.path.expanduser('~/.cache'))
+	path = os.path.join(base, 'sdk_tools')
+	os.makedirs(path, exist_ok=True)
+	return path
+
+
+def get_data_dir() -> str:
+	"""
+	Returns the per-user data directory for sdk_tools, creating it if needed
+	Unlike the cache directory, things kept here are not safe to delete
+
+	Returns
+	-------
+	str
+		Path to the data directory
+	"""
+	if sys.platform.startswith('win'):
+		base = os.getenv('APPDATA', os.path.expanduser('~\\AppData\\Roaming'))
+	else:
+		base = os.getenv('XDG_DATA_HOME', os.path.expanduser('~/.local/share'))
+	path = os.path.join(base, 'sdk_tools')
+	os.makedirs(path, exist_ok=True)
+	return path
@@ -0,0 +1,146 @@
+import os
+import re
+import sys
+import codecs
+import subprocess
+import timeit
+
+# A progress counter tick as printed by the Source compile tools, i.e. "PortalFlow: 0...1...2...3...4...5...6...7...8...9...10"
+_TICK = re.compile(r'(\d+)\.\.\.')
+# vrad prints one of these per radiosity bounce
+_BOUNCE = re.compile(r'Bounce #(\d+) added RAD')
+
+
+class PhaseParser:
+	"""
+	Turns compiler output into timestamped sub-phases
+
+	Two kinds of markers are recognised: "Name: 0...1...2..." progress counters, which become a phase
+	spanning the first and last tick with the time of each tick, and vrad's "Bounce #N added RAD" lines,
+	which become a phase running from the previous marker to the bounce line.
+	"""
+	def __init__(self):
+		self.phases: list[dict] = []
+		self._line = ''
+		self._ticks = 0
+		self._current: dict | None = None
+		self._last_mark = 0.0
+		self._names: dict[str, int] = {}
+
+	def _unique(self, name: str) -> str:
+		n = self._names.get(name, 0) + 1
+		self._names[name] = n
+		return name if n == 1 else f'{name} #{n}'
+
+	def _scan_ticks(self, t: float):
+		ticks = _TICK.findall(self._line)
+		if self._current is None and len(ticks) > 0 and ticks[0] == '0':
+			name = self._line[:self._line.index('0...')].strip().rstrip(':').strip()
+			if len(name) == 0:
+				name = 'progress'
+			self._current = {'name': self._unique(name), 'start': t, 'end': t, 'progress': []}
+			self._ticks = 0
+		if self._current is not None:
+			for v in ticks[self._ticks:]:
+				self._current['progress'].append([int(v), t])
+				self._current['end'] = t
+			self._ticks = len(ticks)
+
+	def _end_line(self, t: float):
+		if self._current is not None:
+			# The final "10" has no trailing dots
+			m = re.match(r'\s*(\d+)', self._line[self._line.rindex('...') + 3:])
+			if m is not None:
+				self._current['progress'].append([int(m.group(1)), t])
+			self._current['end'] = t
+			self._current['duration'] = self._current['end'] - self._current['start']
+			self.phases.append(self._current)
+			self._last_mark = t
+			self._current = None
+		else:
+			m = _BOUNCE.search(self._line)
+			if m is not None:
+				self.phases.append({
+					'name': self._unique(f'bounce {m.group(1)}'),
+					'start': self._last_mark,
+					'end': t,
+					'duration': t - self._last_mark,
+				})
+				self._last_mark = t
+		self._line = ''
+		self._ticks = 0
+
+	def feed(self, text: str, t: float):
+		"""Feed a chunk of output received t seconds after the stage started"""
+		text = text.replace('\r\n', '\n').replace('\r', '\n')
+		parts = text.split('\n')
+		for i, p in enumerate(parts):
+			self._line += p
+			self._scan_ticks(t)
+			if i < len(parts) - 1:
+				self._end_line(t)
+
+	def finish(self, t: float) -> list[dict]:
+		if len(self._line) > 0 or self._current is not None:
+			self._end_line(t)
+		return self.phases
+
+
+def run_streamed(cmd: str, log=None, echo: bool = True) -> tuple[subprocess.Popen, list[dict]]:
+	"""
+	Run a shell command, teeing its output to the console and a log while parsing it for phases
+
+	On POSIX the command gets a pseudo-terminal, so the tools flush their progress counters as they go
+	instead of block-buffering into the pipe. The returned process has not been waited on yet, so the
+	caller can reap it with wait4 and collect resource usage.
+
+	Parameters
+	----------
+	cmd: str
+		Command line to run through the shell
+	log: file
+		Text file to append the output to, or None
+	echo: bool
+		Whether to also write the output to stdout
+
+	Returns
+	-------
+	tuple[subprocess.Popen, list[dict]]
+		The exited (but unreaped) process and the phases parsed from its output
+	"""
+	master = None
+	if os.name == 'posix':
+		import pty
+		master, slave = pty.openpty()
+		p = subprocess.Popen(cmd, shell=True, stdout=slave, stderr=slave)
+		os.close(slave)
+		fd = master
+	else:
+		p = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+		fd = p.stdout.fileno()
+
+	start = timeit.default_timer()
+	parser = PhaseParser()
+	decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+	while True:
+		try:
+			data = os.read(fd, 65536)
+		except OSError:
+			# Linux raises EIO on the pty once the child side is closed
+			break
+		if len(data) == 0:
+			break
+		text = decoder.decode(data)
+		parser.feed(text, timeit.default_timer() - start)
+		if echo:
+			sys.stdout.write(text)
+			sys.stdout.flush()
+		if log is not None:
+			log.write(text.replace('\r\n', '\n'))
+			log.flush()
+
+	if master is not None:
+		os.close(master)
+	else:
+		p.stdout.close()
+	return p, parser.finish(timeit.default_timer() - start)
@@ -0,0 +1,161 @@
+import os
+import json
+import urllib3
+
+# Size of the chunks streamed to disk. A read cut short by a dropped connection loses its chunk,
+# so keep these small enough that a resume doesn't refetch much
+CHUNK_SIZE = 64 * 1024
+
+
+class DownloadError(Exception):
+	pass
+
+
+class Downloader:
+	"""
+	HTTP downloader sharing one keep-alive connection pool between threads
+
+	Files are streamed to a .part file beside the destination and renamed into place once complete, so the
+	destination is never left half written. If a transfer is interrupted, the .part file and a small .part.json
+	recording the ETag and size are kept, and the next attempt (or the next run) resumes with a Range request.
+
+	Parameters
+	----------
+	connections: int
+		Maximum number of connections kept open per host. Threads past this wait for a free connection
+	retries: int
+		Number of times to retry a request on connection errors and 5xx responses, and to resume a
+		transfer that dropped part way through
+	timeout: float
+		Connect and read timeout in seconds
+	"""
+	def __init__(self, connections: int = 8, retries: int = 3, timeout: float = 60):
+		self.retries = retries
+		self.http = urllib3.PoolManager(
+			num_pools=4,
+			maxsize=connections,
+			block=True,
+			retries=urllib3.Retry(total=retries, backoff_factor=0.5, status_forcelist=[500, 502, 503, 504]),
+			timeout=urllib3.Timeout(connect=timeout, read=timeout),
+		)
+
+	def _remote_size(self, url: str) -> int | None:
+		r = self.http.request('HEAD', url)
+		if r.status != 200 or 'Content-Length' not in r.headers:
+			return None
+		return int(r.headers['Content-Length'])
+
+	def fetch(self, url: str, path: str, reuse: bool = True) -> int | None:
+		"""
+		Download url to path
+
+		Parameters
+		----------
+		url: str
+			URL to download
+		path: str
+			Where to save it
+		reuse: bool
+			Keep an existing file at path if the server reports the same size for it
+
+		Returns
+		-------
+		int|None
+			Number of bytes received, counting every attempt. 0 if the existing file was kept, None if the
+			server doesn't have it (404)
+
+		Raises
+		------
+		DownloadError
+			On any other HTTP error, or if the transfer kept failing. Any partial download is kept to resume from
+		"""
+		# Shared with each attempt, so a transfer that drops part way through still counts what it got
+		received = [0]
+		for attempt in range(self.retries + 1):
+			try:
+				# A HEAD that fails is retried like the download. Once it's answered, retries go straight to the download
+				if reuse and os.path.exists(path):
+					size = self._remote_size(url)
+					if size is not None and size == os.path.getsize(path):
+						return 0
+					reuse = False
+				if not self._fetch_once(url, path, received):
+					return None
+				return received[0]
+			except (urllib3.exceptions.ProtocolError, urllib3.exceptions.ReadTimeoutError, urllib3.exceptions.MaxRetryError, DownloadError) as e:
+				# MaxRetryError is the pool giving up on a request, i.e. the server was unreachable or kept
+				# answering 5xx. It still leaves the .part file, so the next attempt resumes from it
+				if attempt == self.retries:
+					raise DownloadError(f'{url}: {e}') from e
+		return None
+
+	def _fetch_once(self, url: str, path: str, received: list[int]) -> bool:
+		part = f'{path}.part'
+		meta = f'{path}.part.json'
+
+		# Pick up where the last attempt left off, as long as we know what we were downloading
+		offset = 0
+		info = None
+		if os.path.exists(part):
+			try:
+				with open(meta, 'r') as fp:
+					info = json.load(fp)
+			except (OSError, ValueError):
+				info = None
+			if info is not None and info.get('url') == url:
+				offset = os.path.getsize(part)
+			else:
+				info = None
+
+		headers = {}
+		if offset > 0:
+			headers['Range'] = f'bytes={offset}-'
+			# Only resume if the file hasn't changed on the server, otherwise we get the whole thing
+			if info.get('etag'):
+				headers['If-Range'] = info['etag']
+
+		r = self.http.request('GET', url, headers=headers, preload_content=False)
+		try:
+			if r.status == 404:
+				return False
+			if r.status == 416 and info is not None and info.get('size') == offset:
+				# The last attempt got everything, it just didn't get to the rename
+				return self._finish(part, meta, path)
+			if r.status == 416:
+				# Whatever we have doesn't line up with the file any more, start over next attempt
+				os.remove(part)
+				raise DownloadError('stale partial download discarded')
+			if r.status == 206:
+				start = r.headers.get('Content-Range', '').split(' ')[-1].split('-')[0]
+				if start != str(offset):
+					raise DownloadError(f'server resumed from {start}, expected {offset}')
+				mode = 'ab'
+			elif r.status == 200:
+				offset = 0
+				mode = 'wb'
+			else:
+				raise DownloadError(f'HTTP {r.status}')
+
+			length = r.headers.get('Content-Length')
+			size = offset + int(length) if length is not None else None
+			with open(meta, 'w') as fp:
+				json.dump({'url': url, 'etag': r.headers.get('ETag'), 'size': size}, fp)
+
+			written = offset
+			with open(part, mode) as fp:
+				for chunk in r.stream(CHUNK_SIZE):
+					fp.write(chunk)
+					written += len(chunk)
+					received[0] += len(chunk)
+			if size is not None and written != size:
+				raise DownloadError(f'got {written} of {size} bytes')
+		finally:
+			r.release_conn()
+		return self._finish(part, meta, path)
+
+	@staticmethod
+	def _finish(part: str, meta: str, path: str) -> bool:
+		os.replace(part, path)
+		if os.path.exists(meta):
+			os.remove(meta)
+		return True
@@ -0,0 +1,445 @@
+import os
+import sys
+import errno
+import shutil
+import json
+import hashlib
+import datetime
+import concurrent.futures
+try:
+	import xxhash
+except ImportError:
+	xxhash = None
+
+# From linux/fs.h, clones a whole file by sharing its extents
+FICLONE = 0x40049409
+
+# Bump when the layout of the manifest changes
+MANIFEST_VERSION = 3
+
+# Hash used for new manifests that record hashes, xxhash is several times faster when it's installed
+HASH_ALGORITHM = 'xxh3_128' if xxhash is not None else 'blake2b'
+
+# Errors meaning a fast path isn't available for this pair of files, rather than a real failure
+_UNSUPPORTED = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTTY, errno.EPERM, errno.EBADF}
+
+
+class SyncPlan:
+	"""
+	Work needed to bring a destination in line with a source
+	"""
+	def __init__(self):
+		# (source, destination, size) of every file that needs copying
+		self.copies: list[tuple[str, str, int]] = []
+		# Destination files and folders that don't exist in the source, deepest first
+		self.deletes: list[str] = []
+		self.skipped_files = 0
+		self.skipped_bytes = 0
+		# Size and mtime of every source file by relative path, for the manifest
+		self.files: dict[str, tuple[int, int]] = {}
+
+	@property
+	def copy_bytes(self) -> int:
+		return sum(c[2] for c in self.copies)
+
+	def extend(self, other: 'SyncPlan'):
+		self.copies += other.copies
+		self.deletes += other.deletes
+		self.skipped_files += other.skipped_files
+		self.skipped_bytes += other.skipped_bytes
+		self.files.update(other.files)
+
+
+def check_algorithm(algorithm: str):
+	"""Raises RuntimeError if files can't be hashed with algorithm here"""
+	if algorithm == 'xxh3_128':
+		if xxhash is None:
+			raise RuntimeError('xxhash is needed for this manifest, install it with pip install xxhash')
+	elif algorithm != 'blake2b':
+		raise RuntimeError(f'unknown hash algorithm {algorithm}')
+
+
+def hash_file(path: str, algorithm: str = 'blake2b') -> str:
+	check_algorithm(algorithm)
+	if algorithm == 'xxh3_128':
+		h = xxhash.xxh3_128()
+	else:
+		h = hashlib.blake2b(digest_size=16)
+	with open(path, 'rb') as fp:
+		while chunk := fp.read(1024 * 1024):
+			h.update(chunk)
+	return h.hexdigest()
+
+
+def is_unchanged(src: str, sst: os.stat_result, dst: str, checksum: bool = False) -> bool:
+	"""
+	Whether the destination already matches the source
+
+	Files match when their size and modification time (to the second, as some filesystems can't store
+	more) agree. With checksum the contents are hashed instead, which catches changes that kept the mtime.
+	"""
+	try:
+		dst_st = os.stat(dst)
+	except (FileNotFoundError, NotADirectoryError):
+		return False
+	if dst_st.st_size != sst.st_size:
+		return False
+	if checksum:
+		return hash_file(src) == hash_file(dst)
+	return int(dst_st.st_mtime) == int(sst.st_mtime)
+
+
+def plan_file(src: str, dst: str, checksum: bool = False) -> SyncPlan:
+	plan = SyncPlan()
+	st = os.stat(src)
+	if is_unchanged(src, st, dst, checksum):
+		plan.skipped_files += 1
+		plan.skipped_bytes += st.st_size
+	else:
+		plan.copies.append((src, dst, st.st_size))
+	return plan
+
+
+def plan_tree(src: str, dst: str, checksum: bool = False, delete: bool = False, manifest: dict | None = None) -> SyncPlan:
+	"""
+	Work out what needs copying to make dst a mirror of src
+
+	Parameters
+	----------
+	src: str
+		Source folder
+	dst: str
+		Destination folder, which may not exist yet
+	checksum: bool
+		Compare file contents instead of size and mtime
+	delete: bool
+		Also remove files and folders in dst that aren't in src. Anything in dst that is a file where src has
+		a folder, or the reverse, is always removed so the source can take its place
+	manifest: dict|None
+		Manifest from the last sync of dst. Files it lists with the same size and mtime as the source are
+		taken as unchanged without looking at dst at all, so a copy edited or deleted since isn't noticed.
+		Ignored with checksum
+
+	Returns
+	-------
+	SyncPlan
+		Files to copy and delete, and what was already up to date
+	"""
+	plan = SyncPlan()
+	known = manifest['files'] if manifest is not None and not checksum else {}
+	pending = ['']
+	while len(pending) > 0:
+		rel = pending.pop()
+		sdir = os.path.join(src, rel)
+		ddir = os.path.join(dst, rel)
+		names = set()
+		with os.scandir(sdir) as it:
+			for e in it:
+				names.add(e.name)
+				target = os.path.join(ddir, e.name)
+				if e.is_dir():
+					if os.path.lexists(target) and not os.path.isdir(target):
+						plan.deletes += _delete_order(target)
+					pending.append(os.path.join(rel, e.name))
+					continue
+				st = e.stat()
+				key = os.path.join(rel, e.name).replace(os.sep, '/')
+				plan.files[key] = (st.st_size, st.st_mtime_ns)
+				entry = known.get(key)
+				if entry is not None and entry['size'] == st.st_size and entry['mtime'] == st.st_mtime_ns:
+					plan.skipped_files += 1
+					plan.skipped_bytes += st.st_size
+				elif is_unchanged(e.path, st, target, checksum):
+					plan.skipped_files += 1
+					plan.skipped_bytes += st.st_size
+				else:
+					if os.path.isdir(target) and not os.path.islink(target):
+						plan.deletes += _delete_order(target)
+					plan.copies.append((e.path, target, st.st_size))
+		if delete and os.path.isdir(ddir):
+			plan.deletes += _extraneous(ddir, names)
+	return plan
+
+
+def _extraneous(ddir: str, names: set[str]) -> list[str]:
+	"""Everything under ddir whose top level name isn't in names, children before their parents"""
+	out = []
+	with os.scandir(ddir) as it:
+		for e in it:
+			if e.name not in names:
+				out += _delete_order(e.path)
+	return out
+
+
+def _delete_order(path: str) -> list[str]:
+	"""path and, if it's a folder, everything in it, children before their parents"""
+	out = []
+	if os.path.isdir(path) and not os.path.islink(path):
+		for root, dirs, files in os.walk(path, topdown=False):
+			out += [os.path.join(root, f) for f in files]
+			out += [os.path.join(root, d) for d in dirs]
+	out.append(path)
+	return out
+
+
+def _copy_data(src: str, dst: str, reflink: bool):
+	"""Copy file contents, sharing extents or staying in the kernel where the platform allows"""
+	with open(src, 'rb') as fin, open(dst, 'wb') as fout:
+		if reflink and sys.platform.startswith('linux'):
+			import fcntl
+			try:
+				fcntl.ioctl(fout.fileno(), FICLONE, fin.fileno())
+				return
+			except OSError as e:
+				if e.errno not in _UNSUPPORTED:
+					raise
+		if hasattr(os, 'copy_file_range'):
+			try:
+				while os.copy_file_range(fin.fileno(), fout.fileno(), 1 << 30) > 0:
+					pass
+				return
+			except OSError as e:
+				if e.errno not in _UNSUPPORTED:
+					raise
+				fin.seek(0)
+				fout.seek(0)
+				fout.truncate()
+	# shutil uses sendfile on Linux and fcopyfile on macOS when it can
+	shutil.copyfile(src, dst)
+
+
+def copy_file(src: str, dst: str, mode: str = 'copy'):
+	"""
+	Copy a file along with its mtime, so the next sync sees it as unchanged
+
+	The file is written beside the destination and renamed over it, so an interrupted copy never leaves a
+	truncated file behind, and a destination that is a hard link to the source is replaced rather than written through.
+
+	Parameters
+	----------
+	src: str
+		File to copy
+	dst: str
+		Where to put it
+	mode: str
+		'copy' for a regular copy, 'reflink' to share the data on copy-on-write filesystems (Btrfs, XFS, APFS...),
+		or 'hardlink' to link the destination to the source. Both fall back to a copy where unsupported
+	"""
+	os.makedirs(os.path.dirname(dst), exist_ok=True)
+	tmp = os.path.join(os.path.dirname(dst), f'.{os.path.basename(dst)}.sync-tmp')
+	try:
+		if mode == 'hardlink':
+			try:
+				os.link(src, tmp)
+				os.replace(tmp, dst)
+				return
+			except OSError as e:
+				if e.errno not in _UNSUPPORTED:
+					raise
+		_copy_data(src, tmp, mode == 'reflink')
+		shutil.copystat(src, tmp)
+		os.replace(tmp, dst)
+	finally:
+		if os.path.lexists(tmp):
+			os.remove(tmp)
+
+
+def apply_plan(plan: SyncPlan, dry: bool = False, verbose: bool = False, jobs: int = 1, mode: str = 'copy'):
+	"""
+	Carry out a sync plan, deleting first so a file replaced by a folder (or the reverse) works out
+
+	Parameters
+	----------
+	plan: SyncPlan
+		Plan from plan_tree/plan_file
+	dry: bool
+		Only print what would be done
+	verbose: bool
+		Print every file copied or deleted
+	jobs: int
+		Number of files to copy at once
+	mode: str
+		Copy mode passed to copy_file
+	"""
+	for p in plan.deletes:
+		if verbose or dry:
+			print(f'Delete {p}')
+		if not dry:
+			if os.path.isdir(p) and not os.path.islink(p):
+				os.rmdir(p)
+			else:
+				os.remove(p)
+
+	if dry:
+		for src, dst, _ in plan.copies:
+			print(f'Copy {src} -> {dst}')
+		return
+
+	def copy(src: str, dst: str):
+		copy_file(src, dst, mode)
+		if verbose:
+			print(f'Copy {src} -> {dst}')
+
+	# Biggest first, so one large file doesn't end up running alone at the end
+	todo = sorted(plan.copies, key=lambda c: c[2], reverse=True)
+	if jobs <= 1:
+		for src, dst, _ in todo:
+			copy(src, dst)
+		return
+	with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+		futures = [pool.submit(copy, src, dst) for src, dst, _ in todo]
+		for f in concurrent.futures.as_completed(futures):
+			# Surface the first failure, the pool finishes what's in flight on the way out
+			e = f.exception()
+			if e is not None:
+				for other in futures:
+					other.cancel()
+				raise e
+
+
+def manifest_path(out: str, d: str) -> str:
+	"""Manifest location for a synced dir, e.g. p2ce/bin is recorded in <out>/.sync-manifests/p2ce.bin.json"""
+	name = d.strip('/\\').replace('/', '.').replace('\\', '.')
+	return os.path.join(out, '.sync-manifests', f'{name}.json')
+
+
+def load_manifest(path: str) -> dict | None:
+	"""Returns the manifest at path, or None if there isn't a usable one"""
+	try:
+		with open(path, 'r', encoding='utf-8') as fp:
+			m = json.load(fp)
+	except (OSError, ValueError):
+		return None
+	if m.get('version') != MANIFEST_VERSION:
+		return None
+	return m
+
+
+def build_manifest(src: str, dst: str, plan: SyncPlan, previous: dict | None = None, jobs: int = 1, hashes: bool = False) -> dict:
+	"""
+	Describe a freshly synced dir from its plan, without touching the files
+
+	Parameters
+	----------
+	src: str
+		Folder that was synced from
+	dst: str
+		Folder that was synced to
+	plan: SyncPlan
+		The plan that was applied
+	previous: dict|None
+		Manifest from the sync before this one
+	jobs: int
+		Number of files to hash at once
+	hashes: bool
+		Also record a hash of every file, so verify_manifest can check contents. Hashes of files that weren't
+		copied are reused from previous when it has them, everything else is read back and hashed in parallel
+
+	Returns
+	-------
+	dict
+		Manifest listing the size, mtime and, with hashes, the hash of every file
+	"""
+	files = {rel: {'size': size, 'mtime': mtime, 'hash': None} for rel, (size, mtime) in sorted(plan.files.items())}
+	if hashes:
+		copied = {os.path.relpath(d, dst).replace(os.sep, '/') for _, d, _ in plan.copies}
+		old = previous['files'] if previous is not None and previous.get('algorithm') == HASH_ALGORITHM else {}
+		todo = []
+		for rel, e in files.items():
+			o = old.get(rel)
+			if rel not in copied and o is not None and o['size'] == e['size'] and o['mtime'] == e['mtime']:
+				e['hash'] = o['hash']
+			else:
+				todo.append(rel)
+		with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+			for rel, h in zip(todo, pool.map(lambda r: hash_file(os.path.join(dst, r), HASH_ALGORITHM), todo)):
+				files[rel]['hash'] = h
+	return {
+		'version': MANIFEST_VERSION,
+		'source': src,
+		# None when no hashes were recorded
+		'algorithm': HASH_ALGORITHM if hashes else None,
+		'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+		'files': files,
+	}
+
+
+def write_manifest(path: str, manifest: dict):
+	os.makedirs(os.path.dirname(path), exist_ok=True)
+	tmp = f'{path}.tmp'
+	with open(tmp, 'w', encoding='utf-8') as fp:
+		json.dump(manifest, fp, indent='\t')
+	os.replace(tmp, path)
+
+
+def verify_manifest(dst: str, manifest: dict, jobs: int = 1, extra: bool = False) -> list[str]:
+	"""
+	Check a synced dir against its manifest, hashing files in parallel
+	Manifests without hashes can only be checked against the size and mtime (to the second) of each file
+
+	Parameters
+	----------
+	dst: str
+		Folder the manifest describes
+	manifest: dict
+		Manifest from load_manifest
+	jobs: int
+		Number of files to hash at once
+	extra: bool
+		Also report files that aren't in the manifest
+
+	Returns
+	-------
+	list[str]
+		One line per problem found, empty if the dir matches
+
+	Raises
+	------
+	RuntimeError
+		If the manifest's hash algorithm isn't available, before anything is checked
+	"""
+	algorithm = manifest['algorithm']
+	if algorithm is not None:
+		check_algorithm(algorithm)
+	problems = []
+	todo = []
+	for rel, e in manifest['files'].items():
+		p = os.path.join(dst, rel)
+		try:
+			st = os.stat(p)
+		except (FileNotFoundError, NotADirectoryError):
+			problems.append(f'missing: {rel}')
+			continue
+		if st.st_size != e['size']:
+			problems.append(f'size differs ({st.st_size} != {e["size"]}): {rel}')
+		elif algorithm is not None:
+			todo.append(rel)
+		elif int(st.st_mtime) != e['mtime'] // 1_000_000_000:
+			problems.append(f'modified since sync: {rel}')
+
+	with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+		for rel, h in zip(todo, pool.map(lambda r: hash_file(os.path.join(dst, r), algorithm), todo)):
+			if h != manifest['files'][rel]['hash']:
+				problems.append(f'contents differ: {rel}')
+
+	if extra:
+		for root, dirs, files in os.walk(dst):
+			for f in files:
+				rel = os.path.relpath(os.path.join(root, f), dst).replace(os.sep, '/')
+				if rel not in manifest['files']:
+					problems.append(f'not in manifest: {rel}')
+	return sorted(problems)
+
+
+def format_size(n: float) -> str:
+	for unit in ['B', 'KiB', 'MiB', 'GiB']:
+		if n < 1024:
+			return f'{n:.1f} {unit}' if unit != 'B' else f'{int(n)} B'
+		n /= 1024
+	return f'{n:.1f} TiB'
+
+
+def describe_plan(plan: SyncPlan) -> str:
+	return (f'{len(plan.copies)} files copied ({format_size(plan.copy_bytes)}), '
+		f'{plan.skipped_files} unchanged ({format_size(plan.skipped_bytes)}), '
+		f'{len(plan.deletes)} extraneous removed')
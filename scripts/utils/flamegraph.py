@@ -0,0 +1,160 @@
+import os
+import re
+import html
+import zlib
+
+# A frame line from perf script: address, symbol and the DSO it lives in
+_FRAME = re.compile(r'^\s*([0-9a-fA-F]+)\s+(.*?)\s+\((.*)\)\s*$')
+# Samples without a call graph have their one frame on the same line as the command name
+_INLINE = re.compile(r'^(\S.*?)\s+([0-9a-fA-F]+)\s+(.*?)\s+\((.*)\)\s*$')
+
+
+def _frame_name(sym: str, dso: str) -> str:
+	sym = re.sub(r'\+0x[0-9a-fA-F]+$', '', sym)
+	if len(sym) == 0 or sym == '[unknown]':
+		return f'[{os.path.basename(dso)}]'
+	# ; separates frames in the folded format
+	return sym.replace(';', ':')
+
+
+def fold_perf_script(lines) -> dict[str, int]:
+	"""
+	Collapse the output of `perf script -F comm,ip,sym,dso` into folded stacks
+
+	Parameters
+	----------
+	lines: Iterable[str]
+		Lines of perf script output
+
+	Returns
+	-------
+	dict[str, int]
+		Sample count of every unique stack, as "comm;outermost;...;innermost"
+	"""
+	stacks: dict[str, int] = {}
+	comm = None
+	frames: list[str] = []
+
+	def flush():
+		if comm is not None:
+			key = ';'.join([comm] + frames[::-1])
+			stacks[key] = stacks.get(key, 0) + 1
+
+	for line in lines:
+		line = line.rstrip('\n')
+		if len(line.strip()) == 0:
+			flush()
+			comm = None
+			frames = []
+		elif line[0].isspace():
+			m = _FRAME.match(line)
+			if m is not None and comm is not None:
+				frames.append(_frame_name(m.group(2), m.group(3)))
+		else:
+			flush()
+			frames = []
+			m = _INLINE.match(line)
+			if m is not None:
+				comm = m.group(1).strip()
+				frames.append(_frame_name(m.group(3), m.group(4)))
+			else:
+				comm = line.strip()
+	flush()
+	return stacks
+
+
+def write_folded(stacks: dict[str, int], path: str):
+	with open(path, 'w', encoding='utf-8') as fp:
+		for k, n in sorted(stacks.items()):
+			fp.write(f'{k} {n}\n')
+
+
+def top_symbols(stacks: dict[str, int], n: int) -> list[dict]:
+	"""
+	Symbols with the most self samples, i.e. the innermost frame of each stack
+
+	Returns
+	-------
+	list[dict]
+		symbol, samples and percent of total for the n hottest symbols
+	"""
+	total = sum(stacks.values())
+	self_counts: dict[str, int] = {}
+	for k, c in stacks.items():
+		leaf = k.rsplit(';', 1)[-1]
+		self_counts[leaf] = self_counts.get(leaf, 0) + c
+	top = sorted(self_counts.items(), key=lambda kv: kv[1], reverse=True)[:n]
+	return [{'symbol': s, 'samples': c, 'percent': c / total * 100 if total > 0 else 0} for s, c in top]
+
+
+def _colour(name: str) -> str:
+	# Stable warm colours, so the same function looks the same across graphs
+	h = zlib.crc32(name.encode('utf-8'))
+	return f'rgb({205 + h % 50},{(h >> 8) % 200},{(h >> 16) % 55})'
+
+
+def render_svg(stacks: dict[str, int], path: str, title: str = 'Flame Graph', width: int = 1200):
+	"""
+	Render folded stacks as an SVG flame graph
+
+	Frame widths are proportional to their sample counts, with callers below callees. Hovering a frame
+	shows its full name and share of the samples.
+
+	Parameters
+	----------
+	stacks: dict[str, int]
+		Folded stacks as returned by fold_perf_script
+	path: str
+		SVG file to write
+	title: str
+		Heading drawn above the graph
+	width: int
+		Width of the image in pixels
+	"""
+	# Merge stacks into a tree: name -> [count, children]
+	root = [0, {}]
+	for k, c in stacks.items():
+		node = root
+		node[0] += c
+		for f in k.split(';'):
+			node = node[1].setdefault(f, [0, {}])
+			node[0] += c
+
+	frame_h = 16
+	pad = 10
+	top = 30
+	total = max(root[0], 1)
+	scale = (width - pad * 2) / total
+
+	rects = []
+	max_depth = 0
+	pending = [(root, pad, 0)]
+	while len(pending) > 0:
+		node, x, depth = pending.pop()
+		for name, child in sorted(node[1].items()):
+			w = child[0] * scale
+			# Too thin to see, and so are all of its children
+			if w >= 0.1:
+				rects.append((name, child[0], x, depth, w))
+				max_depth = max(max_depth, depth + 1)
+				pending.append((child, x, depth + 1))
+			x += w
+
+	height = top + max_depth * frame_h + pad
+	with open(path, 'w', encoding='utf-8') as fp:
+		fp.write(f'<?xml version="1.0" standalone="no"?>\n<svg version="1.1" width="{width}" height="{height}" '
+			f'xmlns="http://www.w3.org/2000/svg" font-family="Verdana" font-size="12">\n')
+		fp.write('<rect width="100%" height="100%" fill="#f8f8f8"/>\n')
+		fp.write(f'<text x="{width / 2}" y="20" text-anchor="middle" font-size="16">{html.escape(title)}</text>\n')
+		for name, count, x, depth, w in rects:
+			y = height - pad - (depth + 1) * frame_h
+			label = html.escape(name)
+			fp.write(f'<g><title>{label} ({count} samples, {count / total * 100:.2f}%)</title>'
+				f'<rect x="{x:.2f}" y="{y}" width="{w:.2f}" height="{frame_h - 1}" fill="{_colour(name)}" rx="2"/>')
+			# Roughly 7px per character at this font size
+			chars = int((w - 6) / 7)
+			if chars >= 3:
+				text = name if len(name) <= chars else name[:chars - 2] + '..'
+				fp.write(f'<text x="{x + 3:.2f}" y="{y + frame_h - 4}">{html.escape(text)}</text>')
+			fp.write('</g>\n')
+		fp.write('</svg>\n')
@@ -0,0 +1,76 @@
+import os
+import sqlite3
+import hashlib
+import zlib
+
+
+def get_mount_stamp(path: str) -> str | None:
+	"""
+	Computes a cheap fingerprint for a mount that changes whenever its file listing may have changed
+
+	VPKs and ZIPs are keyed on the size and mtime of the directory file. Loose folders are keyed on the
+	mtime of every directory in the tree, which changes whenever a file is added, removed or renamed.
+	A directory's mtime doesn't change when something is added further down, so loose folders still need
+	walking on every run. Only directories are stat'ed though, the files themselves are never touched,
+	which keeps this well below the cost of listing the mount again.
+
+	Parameters
+	----------
+	path: str
+		Path to the folder, VPK or ZIP
+
+	Returns
+	-------
+	str|None
+		Hex digest identifying the current state of the mount, None if it doesn't exist
+	"""
+	if not os.path.exists(path):
+		return None
+	h = hashlib.blake2b(digest_size=16)
+	if os.path.isdir(path):
+		pending = [(path, os.stat(path).st_mtime_ns)]
+		while len(pending) > 0:
+			d, mtime = pending.pop()
+			h.update(f'{os.path.relpath(d, path)}\0{mtime}\n'.encode())
+			with os.scandir(d) as it:
+				for e in it:
+					if e.is_dir(follow_symlinks=False):
+						# Windows fills this in while listing, elsewhere it's the one stat per directory
+						pending.append((e.path, e.stat(follow_symlinks=False).st_mtime_ns))
+	else:
+		# Multi-part VPKs list their contents in the _dir file
+		if path.endswith('.vpk') and not path.endswith('_dir.vpk') and os.path.exists(f'{path[:-4]}_dir.vpk'):
+			path = f'{path[:-4]}_dir.vpk'
+		st = os.stat(path)
+		h.update(f'{st.st_size}\0{st.st_mtime_ns}'.encode())
+	return h.hexdigest()
+
+
+class IndexCache:
+	"""
+	Persistent store of mount file listings, keyed by the absolute mount path
+	"""
+	def __init__(self, path: str):
+		self.path = path
+		if len(os.path.dirname(path)) > 0:
+			os.makedirs(os.path.dirname(path), exist_ok=True)
+		self.db = sqlite3.connect(path)
+		self.db.execute('CREATE TABLE IF NOT EXISTS mounts (path TEXT PRIMARY KEY, stamp TEXT NOT NULL, files BLOB NOT NULL)')
+
+	def load(self, mount: str, stamp: str) -> list[str] | None:
+		"""
+		Returns the cached file listing for a mount, or None if there is no entry or it is stale
+		"""
+		row = self.db.execute('SELECT stamp, files FROM mounts WHERE path = ?', (os.path.abspath(mount),)).fetchone()
+		if row is None or row[0] != stamp:
+			return None
+		data = zlib.decompress(row[1]).decode('utf-8')
+		return data.split('\n') if len(data) > 0 else []
+
+	def store(self, mount: str, stamp: str, files: list[str]):
+		blob = zlib.compress('\n'.join(files).encode('utf-8'))
+		with self.db:
+			self.db.execute('INSERT OR REPLACE INTO mounts (path, stamp, files) VALUES (?, ?, ?)', (os.path.abspath(mount), stamp, blob))
+
+	def close(self):
+		self.db.close()
@@ -1,18 +1,27 @@
 import os
 import sys
-import re
+import json
+from srctools.keyvalues import Keyvalues, NoKeyError, KeyValError
+from utils.cachedir import get_cache_dir
 if sys.platform.startswith('win'):
 	import winreg
 
+# Bump when the layout of the on-disk cache changes
+_CACHE_VERSION = 1
 
-def get_library_folders() -> list[str]:
+# In-process results, so repeated lookups don't touch the disk at all
+_libraries: list[dict] | None = None
+_app_paths: dict[int, str | None] = {}
+
+
+def get_library_vdf() -> str:
 	"""
-	Returns a list of Steam libraries on this system
+	Returns the path to Steam's libraryfolders.vdf on this system
 
 	Returns
 	-------
-	list[str]
-		List of paths for the Steam libraries
+	str
+		Path to libraryfolders.vdf, which may not exist if Steam isn't installed
 	"""
 	sp = ''
 	if sys.platform.startswith('linux'):
@@ -29,9 +38,51 @@ def get_library_folders() -> list[str]:
 		# Check that the file *actually* exists; Steam in Proton doesn't use registry...
 		if not os.path.exists(sp):
 			sp = f'Z:{os.getenv("STEAM_COMPAT_CLIENT_INSTALL_PATH")}\\steam\\steamapps\\libraryfolders.vdf'.replace('/', '\\')
+	return sp
+
+
+def _parse_vdf(path: str) -> Keyvalues:
+	with open(path, 'r', encoding='utf-8', errors='replace') as fp:
+		return Keyvalues.parse(fp, path)
+
+
+def _load_libraries() -> list[dict]:
+	"""
+	Parse libraryfolders.vdf into a list of libraries and the apps Steam says each one holds
+
+	Newer Steam versions list the installed apps under each library. Older ones only give the path, in
+	which case apps is None and the library has to be searched for manifests.
+	"""
+	global _libraries
+	if _libraries is not None:
+		return _libraries
+
+	libs = []
+	for block in _parse_vdf(get_library_vdf()).find_children('libraryfolders'):
+		if not block.name.isdigit():
+			continue
+		if block.has_children():
+			apps = None
+			if 'apps' in block:
+				apps = [int(a.real_name) for a in block.find_children('apps') if a.real_name.isdigit()]
+			libs.append({'path': block['path'], 'apps': apps})
+		else:
+			# Old format, "1" "D:\\SteamLibrary"
+			libs.append({'path': block.value, 'apps': None})
+	_libraries = libs
+	return libs
 
-	with open(sp, 'r') as fp:
-		return [x[1] for x in re.findall(r'\n\s+(\"path\")\s+\"(.+)\"\s*\n', fp.read())]
+
+def get_library_folders() -> list[str]:
+	"""
+	Returns a list of Steam libraries on this system
+
+	Returns
+	-------
+	list[str]
+		List of paths for the Steam libraries
+	"""
+	return [lib['path'] for lib in _load_libraries()]
 
 
 def get_library_for_appid(id: int) -> str | None:
@@ -43,17 +94,115 @@ def get_library_for_appid(id: int) -> str | None:
 	str|None
 		Steam library that contains the appid
 	"""
-	folders = get_library_folders()
-	if folders is None:
+	for lib in _app_libraries(id):
+		if os.path.exists(f'{lib}/steamapps/appmanifest_{id}.acf'):
+			return lib
+	return None
+
+
+def _app_libraries(id: int) -> list[str]:
+	"""
+	Every library, the ones Steam lists the app under first. A listing can outlive the app's manifest,
+	i.e. after a partial uninstall or a moved library, so the rest still need checking
+	"""
+	libs = _load_libraries()
+	listed = [lib['path'] for lib in libs if lib['apps'] is not None and id in lib['apps']]
+	return listed + [lib['path'] for lib in libs if lib['path'] not in listed]
+
+
+def _read_app_manifest(library: str, id: int) -> str | None:
+	"""Install path from an app manifest, or None if it's missing or has no installdir"""
+	try:
+		kv = _parse_vdf(f'{library}/steamapps/appmanifest_{id}.acf')
+		return f'{library}/steamapps/common/{kv.find_key("AppState")["installdir"]}'
+	except (OSError, NoKeyError, KeyValError):
+		return None
+
+
+def _mtime(path: str) -> int | None:
+	try:
+		return os.stat(path).st_mtime_ns
+	except OSError:
 		return None
 
-	for folder in folders:
-		if os.path.exists(f'{folder}/steamapps/appmanifest_{id}.acf'):
-			return folder
-	return None
 
+def _cache_path() -> str:
+	return os.path.join(get_cache_dir(), 'steam-apps.json')
 
-def get_appid_path(id: int) -> str | None:
+
+def _load_disk_cache(vdf_mtime: int | None) -> dict:
+	"""Cached app entries, or nothing if libraryfolders.vdf changed since they were written"""
+	try:
+		with open(_cache_path(), 'r', encoding='utf-8') as fp:
+			c = json.load(fp)
+	except (OSError, ValueError):
+		return {}
+	if c.get('version') != _CACHE_VERSION or c.get('vdf') != get_library_vdf() or c.get('vdf_mtime') != vdf_mtime:
+		return {}
+	return c.get('apps', {})
+
+
+def _save_disk_cache(vdf_mtime: int | None, apps: dict):
+	try:
+		tmp = f'{_cache_path()}.{os.getpid()}.tmp'
+		with open(tmp, 'w', encoding='utf-8') as fp:
+			json.dump({'version': _CACHE_VERSION, 'vdf': get_library_vdf(), 'vdf_mtime': vdf_mtime, 'apps': apps}, fp)
+		os.replace(tmp, _cache_path())
+	except OSError:
+		# Only a cache, the lookup itself still worked
+		pass
+
+
+def get_appid_paths(ids: list[int], disk_cache: bool = True) -> dict[int, str | None]:
+	"""
+	Locates the install paths of several AppIDs at once
+
+	libraryfolders.vdf is parsed at most once per process, and each app manifest at most once. With
+	disk_cache, resolved paths are also kept in the user cache directory and reused by later runs for as
+	long as libraryfolders.vdf and the app's manifest keep the same mtime.
+
+	Parameters
+	----------
+	ids: list[int]
+		AppIDs to look for
+	disk_cache: bool
+		Whether to use the on-disk cache
+
+	Returns
+	-------
+	dict[int, str|None]
+		Install path of each AppID, or None if it could not be found
+	"""
+	out = {id: _app_paths[id] for id in ids if id in _app_paths}
+	todo = [id for id in dict.fromkeys(ids) if id not in out]
+	if len(todo) == 0:
+		return out
+
+	vdf_mtime = _mtime(get_library_vdf())
+	cached = _load_disk_cache(vdf_mtime) if disk_cache else {}
+	dirty = False
+	for id in todo:
+		e = cached.get(str(id))
+		if e is not None and _mtime(e['acf']) == e['acf_mtime']:
+			path = e['path']
+		else:
+			path = None
+			for lib in _app_libraries(id):
+				path = _read_app_manifest(lib, id)
+				if path is not None:
+					break
+			if path is not None:
+				acf = f'{lib}/steamapps/appmanifest_{id}.acf'
+				cached[str(id)] = {'path': path, 'acf': acf, 'acf_mtime': _mtime(acf)}
+				dirty = True
+		_app_paths[id] = out[id] = path
+
+	if disk_cache and dirty:
+		_save_disk_cache(vdf_mtime, cached)
+	return out
+
+
+def get_appid_path(id: int, disk_cache: bool = True) -> str | None:
 	"""
 	Tries to locate the AppID's install location based on Steam's libraryfolders.vdf
 
@@ -61,17 +210,12 @@ def get_appid_path(id: int) -> str | None:
 	----------
 	id: int
 		AppID to look for
-	
+	disk_cache: bool
+		Whether to use the on-disk cache, see get_appid_paths
+
 	Returns
 	-------
 	str|None
 		Install path location or None if it could not be found
 	"""
-	lf = get_library_for_appid(id)
-	if lf is not None:
-		am = {}
-		with open(f'{lf}/steamapps/appmanifest_{id}.acf', 'r') as fp:
-			m = re.findall(r'\n\s+(\"installdir\")\s+\"(.+)\"\s*\n', fp.read())
-			if len(m) > 0:
-				return f'{lf}/steamapps/common/{m[0][1]}'
-	return None
+	return get_appid_paths([id], disk_cache)[id]
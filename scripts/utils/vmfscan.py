@@ -0,0 +1,117 @@
+import srctools.tokenizer as tokenizer
+from srctools.tokenizer import Token
+from srctools.keyvalues import KeyValError
+
+# Entity keys that reference models
+MODEL_KEYS = ['model', 'viewmodel', 'worldmodel']
+
+
+class VMFAssets:
+	"""
+	Asset usage counts gathered by scan_vmf
+	"""
+	def __init__(self):
+		self.textures: dict[str, int] = {}
+		self.models: dict[str, int] = {}
+		self.ents: dict[str, int] = {}
+
+
+def _count(d: dict[str, int], key: str, n: int = 1):
+	if key not in d: d[key] = 0
+	d[key] += n
+
+
+def scan_vmf(path: str, encoding: str = 'utf-8') -> VMFAssets:
+	"""
+	Collects brush side materials, entity models and entity classnames from a VMF in a single streaming pass
+
+	The file is tokenized incrementally and only the handful of keys we care about are kept, so memory
+	use does not grow with the size of the map. The results match what srctools.vmf.VMF would report
+	for the same map: world and brush entity sides (including hidden ones), and the model and classname
+	keys of every entity except worldspawn.
+
+	Parameters
+	----------
+	path: str
+		Path to the VMF
+	encoding: str
+		Text encoding of the VMF
+
+	Returns
+	-------
+	VMFAssets
+		Counts for every material, model and classname seen
+	"""
+	# srctools lists world brushes first, then entities, then hidden entities. Keep each separately
+	# and merge at the end so the ordering of the results matches
+	buckets = {
+		'world': VMFAssets(),
+		'entity': VMFAssets(),
+		'hidden': VMFAssets(),
+	}
+
+	STRING = Token.STRING
+	NEWLINE = Token.NEWLINE
+	BRACE_OPEN = Token.BRACE_OPEN
+	BRACE_CLOSE = Token.BRACE_CLOSE
+
+	# Casefolded names of the blocks we're currently inside, outermost first
+	stack: list[str] = []
+	name: str | None = None
+	# Keys of the entity currently being read, or None if we're not directly in an entity
+	ent: dict[str, str] | None = None
+	side_mat: str | None = None
+
+	with open(path, 'r', encoding=encoding) as fp:
+		tok = tokenizer.Tokenizer(fp, path, KeyValError, string_bracket=True, allow_escapes=True)
+		for tt, value in tok:
+			if tt is STRING:
+				if name is None:
+					name = value
+					continue
+				# "name" "value" pair
+				key = name.casefold()
+				name = None
+				if ent is not None and (len(stack) == 1 or len(stack) == 2 and stack[0] == 'hidden'):
+					ent[key] = value
+				elif side_mat is not None and key == 'material' and stack[-1] == 'side':
+					side_mat = value
+			elif tt is BRACE_OPEN:
+				if name is None:
+					raise tok.error('Block opened without a name!')
+				block = name.casefold()
+				name = None
+				stack.append(block)
+				depth = len(stack)
+				if depth == 1 and block == 'entity' or depth == 2 and stack[0] == 'hidden':
+					ent = {}
+				elif block == 'side' and depth >= 3 and stack[-2] == 'solid' and stack[0] in ('world', 'entity', 'hidden'):
+					side_mat = ''
+			elif tt is BRACE_CLOSE:
+				if len(stack) == 0:
+					raise tok.error('Too many closing brackets!')
+				block = stack.pop()
+				if block == 'side' and side_mat is not None:
+					_count(buckets[stack[0]].textures, side_mat)
+					side_mat = None
+				elif ent is not None and (len(stack) == 0 or len(stack) == 1 and stack[0] == 'hidden'):
+					b = buckets['entity' if len(stack) == 0 else 'hidden']
+					for k in MODEL_KEYS:
+						if k in ent:
+							_count(b.models, ent[k])
+					_count(b.ents, ent.get('classname', ''))
+					ent = None
+			elif tt is NEWLINE:
+				# A lone name on a line opens a block on the next one
+				continue
+			# Anything else ([flags], comments) doesn't affect the keys we collect
+
+	if len(stack) > 0:
+		raise KeyValError(f'End of file reached with {len(stack)} open blocks!', path, None)
+
+	assets = VMFAssets()
+	for b in buckets.values():
+		for k, n in b.textures.items(): _count(assets.textures, k, n)
+		for k, n in b.models.items(): _count(assets.models, k, n)
+		for k, n in b.ents.items(): _count(assets.ents, k, n)
+	return assets